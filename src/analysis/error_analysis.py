@@ -1,24 +1,58 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from multiprocessing import cpu_count
 from lmfit import minimize
 from plotting import make_pdf
 import matplotlib.pyplot as plt
 from scipy.interpolate import griddata
-from copy import deepcopy
+from scipy.stats import f
+from copy import deepcopy, copy
 from tqdm import tqdm
+import csv
+import os
+
+
+monte_carlo_worker_state = {} # Experiment, models and functions of an error analysis worker process, set once by the pool initializer
+
+
+class CheckpointStore():
+    # Append-only CSV of completed error analysis fits. Each row is written and flushed as soon as its fit completes, so an
+    # interrupted run keeps everything finished so far. With resume the existing rows are loaded and new rows are appended.
+    def __init__(self, file, columns, resume=False):
+        self.file = file
+        self.columns = columns
+        if resume and os.path.exists(file):
+            with open(file, 'rb+') as f: # A row cut off by a crash has no line end, even where what is left of it still parses, so it is dropped and redone
+                f.truncate(f.read().rfind(b'\n') + 1)
+        if resume and os.path.exists(file) and os.path.getsize(file) > 0:
+            self.completed = pd.read_csv(file, dtype={'Seed':str}, on_bad_lines='skip', float_precision='round_trip').dropna()
+        else:
+            self.completed = pd.DataFrame(columns=columns)
+            with open(file, 'w', newline='') as f:
+                csv.writer(f).writerow(columns)
+
+    def append(self, row):
+        with open(self.file, 'a', newline='') as f:
+            csv.writer(f).writerow([row[k] for k in self.columns])
+            f.flush()
+            os.fsync(f.fileno())
 
 
 class ErrorAnalysis():
 
-    def __init__(self, opt_params, monte_carlo_iterations=None, rmsd=None, range_factor=None, points=None):
+    def __init__(self, opt_params, monte_carlo_iterations=None, rmsd=None, range_factor=None, points=None, seed=None):
         self.opt_params = opt_params
         self.monte_carlo_iterations = monte_carlo_iterations # For Monte carlo
         self.rmsd = rmsd
+        self.seed = seed
+        self.seed_sequence = np.random.SeedSequence(seed) # Each Monte Carlo replicate draws its noise from its own stream spawned from this
+        self.sampling_name = 'MonteCarlo' # Output file label of the parameter samples, MCMC for posterior samples
+        self.adaptive_tolerance = None # Adaptive Monte Carlo stopping is off unless set with monte_carlo_adaptive_stopping
         self.range_factor = range_factor # For correlation surfaces
         self.points = points
+        self.refinement_levels = 0 # Uniform points x points grid unless set with adaptive_correlation_surfaces
 
     @staticmethod
     def parameter_range(opt_param, scaling_factor=5, num_points=5):
@@ -26,6 +60,24 @@ class ErrorAnalysis():
         opt_param_range = np.logspace(np.log10(opt_param/scaling_factor), np.log10(opt_param*scaling_factor), num_points) # +/- scaling factor orders of magnitude from optimal value
         return opt_param_range
     
+    def adaptive_correlation_surfaces(self, fit_budget, refinement_levels=3, confidence_level=0.95):
+        # Start from the points x points grid and split the cells the confidence contour passes through (or where the RSS rises
+        # steeply next to it) into four, up to refinement_levels times and at most fit_budget fits per parameter pair
+        self.fit_budget = fit_budget
+        self.refinement_levels = refinement_levels
+        self.confidence_level = confidence_level
+
+    def confidence_rss_factor(self, experiment, profiled_parameters, confidence_level):
+        # RSS/RSS(optimum) bounding the confidence region of profiled_parameters parameters (F-test), counting the FRET baselines as fitted
+        data_points = sum([len(fret) for fret in experiment.fret])
+        fitted_parameters = len([k for k in self.opt_params if self.opt_params[k].vary == True]) + 2*len(experiment.fret)
+        return 1 + profiled_parameters/(data_points - fitted_parameters)*f.ppf(confidence_level, profiled_parameters, data_points - fitted_parameters)
+
+    def lattice_value(self, opt_param, i):
+        # Parameter value at node i of the finest lattice, log spaced over the same range as parameter_range
+        lattice_points = (self.points - 1)*2**self.refinement_levels + 1
+        return 10**(np.log10(opt_param/self.range_factor) + i*2*np.log10(self.range_factor)/(lattice_points - 1))
+
     def correlation_pairs(self):
         self.correlation_pairs = {} # Big dictionary of all parameter pair combinations and their associated Parameters objects for passing to fitting routine
         params_to_correlate = [k for k in self.opt_params.keys() if self.opt_params[k].vary == True]
@@ -36,7 +88,9 @@ class ErrorAnalysis():
             param_1_range = self.parameter_range(self.opt_params[params_to_correlate[i]].value, self.range_factor, self.points)
             for j in range(i + 1, len(params_to_correlate)):
                 param_2_range = self.parameter_range(self.opt_params[params_to_correlate[j]].value, self.range_factor, self.points)
-                self.correlation_pairs[f"{params_to_correlate[i]},{params_to_correlate[j]}"] = {f"{params_to_correlate[i]}":[], f"{params_to_correlate[j]}":[], "Parameter sets":[], "RSS":[], 'Fit results':[], 'Result order':[]}
+                self.correlation_pairs[f"{params_to_correlate[i]},{params_to_correlate[j]}"] = {f"{params_to_correlate[i]}":[], f"{params_to_correlate[j]}":[], "Parameter sets":[], "RSS":[], 'Fit results':[], 'Result order':[],
+                'Grid nodes':[], 'Neighbours':[], 'Cells':[], 'Level':0} # Nodes are finest lattice coordinates, cells are (i, j, size) with (i, j) the lower corner
+                spacing = 2**self.refinement_levels
                 for k, param_1 in enumerate(param_1_range): # Iterate over values for each parameter pairing, set the pairs in question to constants, allow params not in correlation pair to be varied
                     for l, param_2 in enumerate(param_2_range):
                         opt_params_copy[params_to_correlate[i]].value = param_1
@@ -45,54 +99,222 @@ class ErrorAnalysis():
                         opt_params_copy[params_to_correlate[j]].vary = False
 
                         self.correlation_pairs[f"{params_to_correlate[i]},{params_to_correlate[j]}"]["Parameter sets"].append(opt_params_copy) # Parallel fit results are not in the same order as this
+                        self.correlation_pairs[f"{params_to_correlate[i]},{params_to_correlate[j]}"]["Grid nodes"].append((k*spacing, l*spacing))
+                        self.correlation_pairs[f"{params_to_correlate[i]},{params_to_correlate[j]}"]["Neighbours"].append(self.grid_neighbour(k*self.points + l))
+                        if (k < self.points - 1) & (l < self.points - 1):
+                            self.correlation_pairs[f"{params_to_correlate[i]},{params_to_correlate[j]}"]["Cells"].append((k*spacing, l*spacing, spacing))
                         opt_params_copy = deepcopy(self.opt_params)
     
-    def parameter_correlation_fits(self, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper):
-        maxParallelProcesses = cpu_count() - 1
+    def parameter_correlation_fits(self, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, objective_jacobian=None, checkpoint_file=None, resume=False):
+        # Grid points of all parameter pairs share one pool. Each pair is fitted outward from the optimum, and a grid point is submitted
+        # once its neighbour one step closer to the optimum has converged, starting from that neighbour's fitted parameters.
+        # With a checkpoint file every completed grid point is appended to it, and resume skips the grid points already in it
+        maxParallelProcesses = max(cpu_count() - 1, 1)
         print('')
         print('### Running parameter correlation fits using {} CPU cores. ###'.format(maxParallelProcesses))
+        checkpoint = None
+        if checkpoint_file is not None:
+            checkpoint = CheckpointStore(checkpoint_file, ['Parameter pair', 'Index', 'RSS'] + list(self.opt_params.keys()), resume)
+        # Adaptive surfaces refine a pair once all of its current grid points are done. Refined points get indices in a fixed order from
+        # the RSS values, so resumed runs rebuild the same grid and pick up its checkpointed points.
+        fitted_params = {} # (parameter pair, grid index): fitted Parameters, or None if the fit failed
+        fitted_rss = {}
         for param_pairs in self.correlation_pairs.keys():
-            parameter_sets = self.correlation_pairs[param_pairs]['Parameter sets']
-            print(f'Running parameter pair {param_pairs}.')
-            with ProcessPoolExecutor(max_workers = maxParallelProcesses) as parallelExecution:
-                future_results = {}
-                with tqdm(total=len(parameter_sets), desc=f"{param_pairs} progress") as pbar:
-                    for x in list(np.arange(len(parameter_sets))):
-                        future_result = parallelExecution.submit(self.parallel_fit_task, parameter_sets[x], experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper)
-                        future_results[future_result] = x
-                    for future in as_completed(future_results):
-                        ax = future_results[future]
+            if checkpoint is not None:
+                for row in checkpoint.completed[checkpoint.completed['Parameter pair'] == param_pairs].to_dict('records'):
+                    fitted_params[(param_pairs, int(row['Index']))] = self.checkpoint_parameters(row)
+                    fitted_rss[(param_pairs, int(row['Index']))] = row['RSS']
+                    self.store_correlation_result(param_pairs, int(row['Index']), fitted_params[(param_pairs, int(row['Index']))], row['RSS'])
+        if len(fitted_params) > 0:
+            print(f'Resuming parameter correlation fits, {len(fitted_params)} grid points already done.')
+        grid_points = sorted([(self.grid_ring(param_pairs, x), param_pairs, x) for param_pairs in self.correlation_pairs.keys() 
+        for x in range(len(self.correlation_pairs[param_pairs]['Parameter sets'])) if (param_pairs, x) not in fitted_params])
+        if self.refinement_levels > 0: # RSS of the joint confidence region of two parameters
+            self.contour_factor = self.confidence_rss_factor(experiment, 2, self.confidence_level)
+
+        with ProcessPoolExecutor(max_workers = maxParallelProcesses, initializer=self.monte_carlo_worker_initializer, 
+        initargs=(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, objective_jacobian)) as parallelExecution:
+            future_results = {}
+            with tqdm(total=len(grid_points) + len(fitted_params), initial=len(fitted_params), desc="Parameter correlation progress") as pbar:
+                while True:
+                    for param_pairs in self.correlation_pairs.keys():
+                        while self.refinable(param_pairs, fitted_params):
+                            refined_points = [x for x in self.refine_correlation_grid(param_pairs, fitted_rss) if (param_pairs, x) not in fitted_params]
+                            grid_points = sorted(grid_points + [(self.grid_ring(param_pairs, x), param_pairs, x) for x in refined_points])
+                            pbar.total += len(refined_points)
+                            pbar.refresh()
+                    if (len(grid_points) == 0) & (len(future_results) == 0):
+                        break
+                    neighbours = {point:self.correlation_pairs[point[1]]['Neighbours'][point[2]] for point in grid_points}
+                    ready_points = [point for point in grid_points if (neighbours[point] is None) or ((point[1], neighbours[point]) in fitted_params)]
+                    for point in ready_points: # Innermost rings first, across all pairs
+                        grid_points.remove(point)
+                        future_result = parallelExecution.submit(self.correlation_fit_task, self.warm_start_parameters(point[1], point[2], fitted_params))
+                        future_results[future_result] = point[1:]
+                    done_futures, running_futures = wait(future_results, return_when=FIRST_COMPLETED)
+                    for future in done_futures:
+                        param_pairs, ax = future_results.pop(future)
                         try:
                             result = future.result()
                         except Exception as exc:
-                            print('%r generated an exception in parameter correlation fits: %s' % (ax, exc))
+                            print('%r generated an exception in parameter correlation fits: %s' % ((param_pairs, ax), exc))
+                            fitted_params[(param_pairs, ax)] = None # Points further out start from the optimum instead
                         else:
                             pbar.update(1)
-                            self.correlation_pairs[param_pairs]['Result order'].append(ax)
-                            self.correlation_pairs[param_pairs]['Fit results'].append(result.params)
-                            self.correlation_pairs[param_pairs]['RSS'].append(result.chisqr)
-                            self.correlation_pairs[param_pairs][param_pairs.split(',')[0]].append(result.params[param_pairs.split(',')[0]].value)
-                            self.correlation_pairs[param_pairs][param_pairs.split(',')[1]].append(result.params[param_pairs.split(',')[1]].value) 
-
-    def monte_carlo_fits(self, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper):
-        maxParallelProcesses = cpu_count() - 1
+                            fitted_params[(param_pairs, ax)] = result.params
+                            fitted_rss[(param_pairs, ax)] = result.chisqr
+                            self.store_correlation_result(param_pairs, ax, result.params, result.chisqr)
+                            if checkpoint is not None:
+                                checkpoint.append({'Parameter pair':param_pairs, 'Index':ax, 'RSS':result.chisqr, **{k:result.params[k].value for k in self.opt_params}})
+
+    def grid_offsets(self, ax):
+        # Offsets of points x points grid point ax from the centre (optimum), ax runs over param 1 then param 2 as in correlation_pairs
+        centre = (self.points - 1)/2
+        return ax//self.points - centre, ax%self.points - centre
+
+    def grid_ring(self, param_pairs, ax):
+        # Distance of a grid point from the optimum in coarse grid steps
+        centre = (self.points - 1)*2**self.refinement_levels/2
+        return max(np.abs(np.array(self.correlation_pairs[param_pairs]['Grid nodes'][ax]) - centre))/2**self.refinement_levels
+
+    def grid_neighbour(self, ax):
+        # Index of the adjacent grid point one step closer to the optimum, None for the innermost points
+        offsets = self.grid_offsets(ax)
+        steps = [int(np.sign(x)) if np.abs(x) >= 1 else 0 for x in offsets]
+        if steps == [0, 0]:
+            return None
+        return ax - steps[0]*self.points - steps[1]
+
+    def refinable(self, param_pairs, fitted_params):
+        pair = self.correlation_pairs[param_pairs]
+        return (pair['Level'] < self.refinement_levels) and all([(param_pairs, x) in fitted_params for x in range(len(pair['Grid nodes']))])
+
+    def refine_correlation_grid(self, param_pairs, fitted_rss):
+        # Split the cells the confidence contour passes through, then the cells where the RSS rises steeply next to it, into four
+        # until the fit budget is spent. New points start from the lowest RSS corner of their cell. Returns the new grid indices.
+        pair = self.correlation_pairs[param_pairs]
+        pair['Level'] += 1
+        node_index = {node:x for x, node in enumerate(pair['Grid nodes'])}
+        rss_min = min([fitted_rss[(param_pairs, x)] for x in range(len(pair['Grid nodes'])) if (param_pairs, x) in fitted_rss])
+        rss_contour = rss_min*self.contour_factor
+        candidates = []
+        for cell in pair['Cells']:
+            corners = [node_index[(cell[0] + a*cell[2], cell[1] + b*cell[2])] for a in [0, 1] for b in [0, 1]]
+            if (cell[2] == 1) or any([(param_pairs, x) not in fitted_rss for x in corners]): # Finest lattice, or a failed corner fit
+                continue
+            corner_rss = [fitted_rss[(param_pairs, x)] for x in corners]
+            contour_crossing = min(corner_rss) <= rss_contour < max(corner_rss)
+            steep = (max(corner_rss) - min(corner_rss) > rss_contour - rss_min) & (min(corner_rss) < rss_min + 4*(rss_contour - rss_min))
+            if contour_crossing or steep:
+                candidates.append((not contour_crossing, min(corner_rss) - max(corner_rss), cell, corners[np.argmin(corner_rss)]))
+
+        refined_points = []
+        param_1, param_2 = param_pairs.split(',')
+        for contour_crossing, rss_span, cell, start_node in sorted(candidates):
+            half = cell[2]//2
+            new_nodes = [(cell[0] + a*half, cell[1] + b*half) for a in [0, 1, 2] for b in [0, 1, 2] if (cell[0] + a*half, cell[1] + b*half) not in node_index]
+            if len(pair['Grid nodes']) + len(new_nodes) > self.fit_budget:
+                continue
+            for node in new_nodes:
+                node_params = deepcopy(pair['Parameter sets'][start_node])
+                node_params[param_1].value = self.lattice_value(self.opt_params[param_1].value, node[0])
+                node_params[param_2].value = self.lattice_value(self.opt_params[param_2].value, node[1])
+                node_index[node] = len(pair['Grid nodes'])
+                refined_points.append(len(pair['Grid nodes']))
+                pair['Parameter sets'].append(node_params)
+                pair['Grid nodes'].append(node)
+                pair['Neighbours'].append(start_node)
+            pair['Cells'].remove(cell)
+            pair['Cells'] += [(cell[0] + a*half, cell[1] + b*half, half) for a in [0, 1] for b in [0, 1]]
+        if len(refined_points) == 0:
+            pair['Level'] = self.refinement_levels
+        return refined_points
+
+    def warm_start_parameters(self, param_pairs, ax, fitted_params):
+        # Grid point parameters with the parameters that are still varied started from the converged neighbouring fit
+        initial_guess_params = deepcopy(self.correlation_pairs[param_pairs]['Parameter sets'][ax])
+        neighbour = self.correlation_pairs[param_pairs]['Neighbours'][ax]
+        if (neighbour is not None) and (fitted_params.get((param_pairs, neighbour)) is not None):
+            for k in initial_guess_params:
+                if initial_guess_params[k].vary == True:
+                    initial_guess_params[k].value = fitted_params[(param_pairs, neighbour)][k].value
+        return initial_guess_params
+
+    def store_correlation_result(self, param_pairs, ax, params, rss):
+        self.correlation_pairs[param_pairs]['Result order'].append(ax)
+        self.correlation_pairs[param_pairs]['Fit results'].append(params)
+        self.correlation_pairs[param_pairs]['RSS'].append(rss)
+        self.correlation_pairs[param_pairs][param_pairs.split(',')[0]].append(params[param_pairs.split(',')[0]].value)
+        self.correlation_pairs[param_pairs][param_pairs.split(',')[1]].append(params[param_pairs.split(',')[1]].value)
+
+    def checkpoint_parameters(self, row):
+        # Parameters object with the fitted values of a checkpoint row
+        params = deepcopy(self.opt_params)
+        for k in params:
+            params[k].value = row[k]
+        return params
+
+    def monte_carlo_fits(self, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, objective_jacobian=None, chunks_per_worker=4, 
+    checkpoint_file=None, resume=False):
+        # Workers receive the experiment, models and functions once through the pool initializer and then fit chunks of replicate indices.
+        # Replicate i perturbs the data with the stream SeedSequence(entropy, spawn_key=(i,)), and results are stored by replicate index,
+        # so a run is reproducible from its seed whatever the number of workers.
+        # With a checkpoint file every completed replicate is appended to it, and resume skips the replicates already in it for this seed.
+        # Without a configured seed, a resumed run continues with the seed of the checkpoint.
+        maxParallelProcesses = max(cpu_count() - 1, 1)
         print('')
         print('### Running Monte Carlo fits using {} CPU cores. ###'.format(maxParallelProcesses))
-        with ProcessPoolExecutor(max_workers = maxParallelProcesses) as parallelExecution:
+        replicate_results = {}
+        checkpoint = None
+        if checkpoint_file is not None:
+            checkpoint = CheckpointStore(checkpoint_file, ['Seed', 'Replicate'] + list(self.opt_params.keys()), resume)
+            if (self.seed is None) & (len(checkpoint.completed) > 0):
+                self.seed_sequence = np.random.SeedSequence(int(checkpoint.completed['Seed'].iloc[-1]))
+            for row in checkpoint.completed[checkpoint.completed['Seed'] == str(self.seed_sequence.entropy)].to_dict('records'):
+                replicate_results[int(row['Replicate'])] = {k:row[k] for k in self.opt_params}
+            if len(replicate_results) > 0:
+                print(f'Resuming Monte Carlo run, {len(replicate_results)} of {self.monte_carlo_iterations} replicates already done.')
+        print(f'Monte Carlo seed: {self.seed_sequence.entropy}')
+        replicates = np.array([x for x in range(self.monte_carlo_iterations) if x not in replicate_results], dtype=int)
+        if self.adaptive_tolerance is not None: # Small chunks in replicate order, so the run can stop soon after convergence
+            pending_chunks = [replicates[x:x + max(self.check_interval//maxParallelProcesses, 1)] for x in range(0, len(replicates), max(self.check_interval//maxParallelProcesses, 1))]
+        else:
+            pending_chunks = [chunk for chunk in np.array_split(replicates, max(min(len(replicates), maxParallelProcesses*chunks_per_worker), 1)) if len(chunk) > 0]
+        self.reset_monte_carlo_convergence()
+        converged = self.monte_carlo_convergence(replicate_results)
+        with ProcessPoolExecutor(max_workers = maxParallelProcesses, initializer=self.monte_carlo_worker_initializer, 
+        initargs=(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, objective_jacobian)) as parallelExecution:
             future_results = {}
-            with tqdm(total=self.monte_carlo_iterations, desc="Monte Carlo progress") as pbar:
-                for x in list(np.arange(1, self.monte_carlo_iterations + 1)):
-                    future_result = parallelExecution.submit(self.monte_carlo_parallel_fit_task, self.opt_params, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, self.rmsd)
-                    future_results[future_result] = x
-                for future in as_completed(future_results):
-                    ax = future_results[future]
-                    try:
-                        result = future.result()
-                    except Exception as exc:
-                        print('%r generated an exception in Monte Carlo fits: %s' % (ax, exc))
-                    else:
-                        {self.monte_carlo_parameters[k].append(result.params[k].value) for k in self.monte_carlo_parameters.keys()}
-                        pbar.update(1)
+            with tqdm(total=self.monte_carlo_iterations, initial=len(replicate_results), desc="Monte Carlo progress") as pbar:
+                while ((len(pending_chunks) > 0) | (len(future_results) > 0)) & (not converged):
+                    while (len(pending_chunks) > 0) & (len(future_results) < 2*maxParallelProcesses): # Keep every worker busy without queueing the whole run
+                        chunk = pending_chunks.pop(0)
+                        future_result = parallelExecution.submit(self.monte_carlo_chunk_task, self.opt_params, list(chunk), self.seed_sequence.entropy, self.rmsd)
+                        future_results[future_result] = chunk
+                    done_futures, running_futures = wait(future_results, return_when=FIRST_COMPLETED)
+                    for future in done_futures:
+                        chunk = future_results.pop(future)
+                        try:
+                            results = future.result()
+                        except Exception as exc:
+                            print('%r generated an exception in Monte Carlo fits: %s' % (list(chunk), exc))
+                        else:
+                            replicate_results.update(results)
+                            pbar.update(len(chunk))
+                            if checkpoint is not None:
+                                for x in sorted(results.keys()):
+                                    checkpoint.append({'Seed':self.seed_sequence.entropy, 'Replicate':x, **results[x]})
+                    converged = self.monte_carlo_convergence(replicate_results)
+                for future in future_results:
+                    future.cancel()
+
+        if converged: # Keep exactly the replicates the stopping decision was made on
+            replicate_results = {x:replicate_results[x] for x in range(self.converged_iterations)}
+            self.monte_carlo_iterations = self.converged_iterations
+        for x in sorted(replicate_results.keys()): # Replicate order, independent of which worker finished first
+            {self.monte_carlo_parameters[k].append(replicate_results[x][k]) for k in self.monte_carlo_parameters.keys()}
+        if self.adaptive_tolerance is not None:
+            self.report_monte_carlo_convergence(converged)
 
         for k in self.monte_carlo_parameters.keys():
             self.monte_carlo_errors[f"{k} error"] = np.std(self.monte_carlo_parameters[k])
@@ -102,29 +324,399 @@ class ErrorAnalysis():
         for k1, k2 in zip(self.monte_carlo_parameters.keys(), self.monte_carlo_errors.keys()):
             print(f"{k1} = {self.opt_params[k1].value} +/- {self.monte_carlo_errors[k2]}")
 
+    def mcmc_sampling(self, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, walkers=None, max_steps=5000, check_interval=100, 
+    initial_spread=1e-3, minimum_samples=100):
+        # Affine invariant ensemble sampler (Goodman & Weare stretch move) for the posterior of the varied parameters, with a Gaussian
+        # likelihood of noise rmsd and flat priors within the parameter bounds, in log10 units for positive parameters. The FRET
+        # baselines are solved at every evaluation as in the fits. Each step costs one simulation per walker: the ensemble is updated
+        # in two halves, and each half is evaluated in chunks on the pool. Every check_interval steps the integrated autocorrelation
+        # time tau is estimated, and sampling stops once the chain is longer than 50 tau with tau changed by less than 1%. The first
+        # 2 tau steps (at most half the chain) are dropped as burn-in and the chain is thinned by tau/2. Samples fill the Monte Carlo outputs.
+        maxParallelProcesses = max(cpu_count() - 1, 1)
+        self.sampling_name = 'MCMC'
+        sampled_params = list(self.monte_carlo_parameters.keys())
+        dimensions = len(sampled_params)
+        if (walkers is not None) and (walkers < 2*dimensions): # The stretch move only explores the span of the other half of the ensemble
+            raise ValueError(f"MCMC needs at least {2*dimensions} walkers for {dimensions} varied parameters, got {walkers}")
+        walkers = max(4*dimensions, 16) if walkers is None else walkers + walkers%2 # Two equal halves
+        log_scaled = np.array([self.opt_params[k].value > 0 for k in sampled_params])
+        lower = np.array([np.log10(self.opt_params[k].min) if log_scaled[i] and self.opt_params[k].min > 0 else (-np.inf if log_scaled[i] else self.opt_params[k].min) for i, k in enumerate(sampled_params)])
+        upper = np.array([np.log10(self.opt_params[k].max) if log_scaled[i] else self.opt_params[k].max for i, k in enumerate(sampled_params)])
+        optimum = np.array([np.log10(self.opt_params[k].value) if log_scaled[i] else self.opt_params[k].value for i, k in enumerate(sampled_params)])
+        print('')
+        print('### Running MCMC sampling with {} walkers using {} CPU cores. ###'.format(walkers, maxParallelProcesses))
+        print(f'MCMC seed: {self.seed_sequence.entropy}')
+        rng = np.random.default_rng(self.seed_sequence)
+        positions = optimum + initial_spread*np.where(log_scaled, 1, np.abs(optimum) + (optimum == 0))*rng.standard_normal((walkers, dimensions))
+        positions = np.clip(positions, lower, upper)
+        chain, log_probabilities, accepted = [], [], np.zeros(walkers)
+        self.mcmc_trace = []
+
+        with ProcessPoolExecutor(max_workers = maxParallelProcesses, initializer=self.monte_carlo_worker_initializer, 
+        initargs=(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, None)) as parallelExecution:
+            log_probability = self.mcmc_log_probabilities(parallelExecution, maxParallelProcesses, positions, log_scaled, lower, upper)
+            for step in tqdm(range(max_steps), desc="MCMC progress"):
+                for half in [0, 1]:
+                    active, complement = np.arange(half, walkers, 2), np.arange(1 - half, walkers, 2)
+                    z = ((rng.random(len(active)) + 1)**2)/2 # Stretch factor with a = 2
+                    partners = positions[rng.choice(complement, len(active))]
+                    proposals = partners + z[:, None]*(positions[active] - partners)
+                    proposal_log_probability = self.mcmc_log_probabilities(parallelExecution, maxParallelProcesses, proposals, log_scaled, lower, upper)
+                    accept = np.log(rng.random(len(active))) < (dimensions - 1)*np.log(z) + proposal_log_probability - log_probability[active]
+                    positions[active[accept]] = proposals[accept]
+                    log_probability[active[accept]] = proposal_log_probability[accept]
+                    accepted[active[accept]] += 1
+                chain.append(positions.copy())
+                log_probabilities.append(log_probability.copy())
+                if (step + 1) % check_interval == 0:
+                    tau = np.array([self.autocorrelation_time(np.array(chain)[:, :, i]) for i in range(dimensions)])
+                    self.mcmc_trace.append({'Steps':step + 1, **{f"{k} tau":tau[i] for i, k in enumerate(sampled_params)}})
+                    if len(self.mcmc_trace) > 1:
+                        previous_tau = np.array([self.mcmc_trace[-2][f"{k} tau"] for k in sampled_params])
+                        if np.all(50*tau < step + 1) & np.all(np.abs(previous_tau - tau)/tau < 0.01):
+                            break
+
+        chain = np.array(chain)
+        tau = np.array([self.autocorrelation_time(chain[:, :, i]) for i in range(dimensions)])
+        # Walkers that never moved or chains shorter than a few tau would leave nothing after 2 tau, so at most half the chain is dropped
+        burn_in = min(int(2*np.max(tau)), len(chain)//2)
+        thin = max(min(int(np.min(tau)/2), (len(chain) - burn_in)//2), 1)
+        samples = chain[burn_in::thin].reshape(-1, dimensions)
+        if len(samples) < 2:
+            raise RuntimeError(f"MCMC left {len(samples)} samples after burn-in and thinning of {len(chain)} steps, increase the maximum number of steps")
+        self.monte_carlo_iterations = len(samples)
+        for i, k in enumerate(sampled_params):
+            self.monte_carlo_parameters[k] = list(10**samples[:, i] if log_scaled[i] else samples[:, i])
+            self.monte_carlo_errors[f"{k} error"] = np.std(self.monte_carlo_parameters[k])
+        self.mcmc_diagnostics = {'Parameter':sampled_params, 'Autocorrelation time':list(tau), 'Effective samples':list(walkers*(len(chain) - burn_in)/tau), 
+        'Acceptance fraction':[np.mean(accepted)/len(chain)]*dimensions, 'Steps':[len(chain)]*dimensions, 'Converged':[bool(np.all(50*tau < len(chain)))]*dimensions}
+
+        print('')
+        print('### MCMC diagnostics ###')
+        print(f"{len(chain)} steps, acceptance fraction {np.mean(accepted)/len(chain):.3f}, burn-in {burn_in} steps, thinned by {thin}, {len(samples)} samples")
+        for i, k in enumerate(sampled_params):
+            print(f"{k}: autocorrelation time {tau[i]:.1f} steps, {walkers*(len(chain) - burn_in)/tau[i]:.0f} effective samples")
+        if not np.all(50*tau < len(chain)):
+            print('Chains are shorter than 50 autocorrelation times, increase the maximum number of steps for reliable errors.')
+        if len(samples) < minimum_samples:
+            print(f"Only {len(samples)} samples are left after burn-in and thinning, fewer than {minimum_samples}, the errors are unreliable.")
+        print('')
+        print('### MCMC parameter error estimates ###')
+        for k1, k2 in zip(self.monte_carlo_parameters.keys(), self.monte_carlo_errors.keys()):
+            print(f"{k1} = {self.opt_params[k1].value} +/- {self.monte_carlo_errors[k2]}")
+
+    def mcmc_log_probabilities(self, parallelExecution, maxParallelProcesses, positions, log_scaled, lower, upper):
+        # Log posterior of each position, positions outside the bounds are rejected without a simulation
+        log_probability = np.full(len(positions), -np.inf)
+        inside = np.where(np.all((positions >= lower) & (positions <= upper), axis=1))[0]
+        chunks = [chunk for chunk in np.array_split(inside, min(maxParallelProcesses, max(len(inside), 1))) if len(chunk) > 0]
+        futures = [parallelExecution.submit(self.mcmc_chunk_task, self.opt_params, list(self.monte_carlo_parameters.keys()), 
+        np.where(log_scaled, 10**positions[chunk], positions[chunk]), self.rmsd) for chunk in chunks]
+        for chunk, future in zip(chunks, futures): # Gathered in submission order, so the chain does not depend on timing
+            log_probability[chunk] = future.result()
+        return log_probability
+
+    @staticmethod
+    def mcmc_chunk_task(opt_params, sampled_params, values, rmsd):
+        # Gaussian log likelihood of each row of parameter values, one simulation each with the models of this worker
+        params = deepcopy(opt_params)
+        log_probability = []
+        for row in values:
+            for i, k in enumerate(sampled_params):
+                params[k].value = row[i]
+            monte_carlo_worker_state['Kinetic model'].carried_sensitivities = ()
+            residuals = monte_carlo_worker_state['Objective'](params, monte_carlo_worker_state['Experiment'], monte_carlo_worker_state['Kinetic model'], 
+            monte_carlo_worker_state['Hybridization model'], monte_carlo_worker_state['Simulate'])
+            log_probability.append(-np.sum(residuals**2)/(2*rmsd**2) if np.all(np.isfinite(residuals)) else -np.inf)
+        return log_probability
+
+    @staticmethod
+    def autocorrelation_time(chain, window_factor=5):
+        # Integrated autocorrelation time of a (steps, walkers) chain from the walker averaged autocorrelation function,
+        # summed up to the first window M with M >= window_factor*tau(M) (Sokal)
+        steps = chain.shape[0]
+        size = 2**int(np.ceil(np.log2(2*steps)))
+        centred = chain - np.mean(chain, axis=0)
+        acf = np.fft.irfft(np.abs(np.fft.rfft(centred, n=size, axis=0))**2, axis=0)[:steps]
+        acf = np.mean(acf, axis=1)
+        if acf[0] == 0: # Walkers that never moved
+            return float(steps)
+        taus = 2*np.cumsum(acf/acf[0]) - 1
+        window = np.arange(len(taus)) < window_factor*taus
+        return taus[np.argmin(window)] if np.any(~window) else taus[-1]
+
+    def save_mcmc_diagnostics(self, sample_name):
+        pd.DataFrame(self.mcmc_diagnostics).to_csv(f"output/{sample_name}_MCMC_diagnostics.csv", index=False)
+        pd.DataFrame(self.mcmc_trace).to_csv(f"output/{sample_name}_MCMC_convergence.csv", index=False)
+
+    def linearized_covariance(self, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_jacobian, optimum_rss, samples=0, condition_limit=1e8):
+        # Covariance of the varied parameters from the sensitivity Jacobian at the optimum, s^2 (J^T J)^-1 with s^2 = RSS/(N - P).
+        # The Jacobian already accounts for the FRET baselines solved at every step. It is decomposed in relative (p dr/dp) units, and
+        # directions with singular values below the largest/condition_limit are reported as ill-conditioned. Parameters that move
+        # in a direction the data do not determine at all get an infinite error.
+        print('')
+        print('### Linearized covariance at the optimum ###')
+        varied_params = [k for k in self.opt_params if self.opt_params[k].vary == True]
+        kinetic_model.carried_sensitivities = ()
+        jacobian = objective_jacobian(self.opt_params, experiment, kinetic_model, hybridization_model, simulate_full_model)
+        scales = np.array([self.opt_params[k].value if self.opt_params[k].value != 0 else 1 for k in varied_params])
+        data_points = sum([len(fret) for fret in experiment.fret])
+        variance = optimum_rss/(data_points - len(varied_params) - 2*len(experiment.fret))
+        U, singular_values, Vt = np.linalg.svd(jacobian*scales, full_matrices=False)
+        identified = singular_values > np.finfo(float).eps*max(jacobian.shape)*singular_values[0]
+        relative_covariance = variance*(Vt[identified].T/singular_values[identified]**2) @ Vt[identified]
+        self.covariance = relative_covariance*np.outer(scales, scales)
+        self.linearized_errors = {k:np.sqrt(self.covariance[i, i]) for i, k in enumerate(varied_params)}
+        for direction in Vt[~identified]:
+            for i, k in enumerate(varied_params):
+                if np.abs(direction[i]) > 1e-3:
+                    self.linearized_errors[k] = np.inf
+        errors = np.array([self.linearized_errors[k] for k in varied_params])
+        self.correlation = self.covariance/np.outer(np.where(np.isfinite(errors), errors, np.nan), np.where(np.isfinite(errors), errors, np.nan))
+        self.condition_number = singular_values[0]/singular_values[-1] if singular_values[-1] > 0 else np.inf
+        self.ill_conditioned_directions = [{k:Vt[j, i] for i, k in enumerate(varied_params)} for j in range(len(singular_values)) 
+        if singular_values[j] < singular_values[0]/condition_limit]
+
+        for k in varied_params:
+            print(f"{k} = {self.opt_params[k].value} +/- {self.linearized_errors[k]}")
+        print(f"Condition number of the relative Jacobian: {self.condition_number:.3e}")
+        for direction in self.ill_conditioned_directions:
+            print('Ill-conditioned direction (relative): ' + ', '.join([f"{k} {v:+.3f}" for k, v in direction.items() if np.abs(v) > 1e-3]))
+
+        self.linearized_samples = None
+        if samples > 0: # Gaussian samples along the determined directions, for plotting
+            rng = np.random.default_rng(self.seed_sequence)
+            relative_samples = rng.standard_normal((samples, np.sum(identified)))*np.sqrt(variance)/singular_values[identified] @ Vt[identified]
+            self.linearized_samples = {k:scales[i]*(1 + relative_samples[:, i]) for i, k in enumerate(varied_params)}
+
+    def save_linearized_covariance(self, sample_name):
+        varied_params = list(self.linearized_errors.keys())
+        pd.DataFrame({'Parameter':varied_params, 'Opt Value':[self.opt_params[k].value for k in varied_params], 
+        'Error':[self.linearized_errors[k] for k in varied_params]}).to_csv(f"output/{sample_name}_linearized_errors.csv", index=False)
+        pd.DataFrame(self.covariance, index=varied_params, columns=varied_params).to_csv(f"output/{sample_name}_linearized_covariance.csv")
+        pd.DataFrame(self.correlation, index=varied_params, columns=varied_params).to_csv(f"output/{sample_name}_linearized_correlation.csv")
+        if self.linearized_samples is not None:
+            pd.DataFrame(self.linearized_samples).to_csv(f"output/{sample_name}_linearized_samples.csv", index=False)
+
+    def profile_likelihood_fits(self, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, objective_jacobian=None, 
+    optimum_rss=None, confidence_level=0.95, initial_step=0.02, max_steps=50, range_factor=100):
+        # Profile each varied parameter up and down from the optimum, refitting the other parameters at every step, until the RSS
+        # crosses the confidence threshold. Each profile direction is one task on the pool, so intervals cost O(parameters x steps) fits.
+        maxParallelProcesses = max(cpu_count() - 1, 1)
+        print('')
+        print('### Running profile likelihood fits using {} CPU cores. ###'.format(maxParallelProcesses))
+        self.profile_threshold = optimum_rss*self.confidence_rss_factor(experiment, 1, confidence_level)
+        self.confidence_level = confidence_level
+        profiled_params = [k for k in self.opt_params.keys() if self.opt_params[k].vary == True]
+        self.profiles = {k:{'Value':[self.opt_params[k].value], 'RSS':[optimum_rss]} for k in profiled_params}
+        self.profile_intervals = {k:{} for k in profiled_params}
+        with ProcessPoolExecutor(max_workers = maxParallelProcesses, initializer=self.monte_carlo_worker_initializer, 
+        initargs=(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, objective_jacobian)) as parallelExecution:
+            future_results = {}
+            for k in profiled_params:
+                for direction in [-1, 1]:
+                    future_result = parallelExecution.submit(self.profile_task, self.opt_params, k, direction, optimum_rss, self.profile_threshold, initial_step, max_steps, range_factor)
+                    future_results[future_result] = (k, direction)
+            for future in tqdm(as_completed(future_results), total=len(future_results), desc="Profile likelihood progress"):
+                k, direction = future_results[future]
+                try:
+                    values, rss, bound, crossed = future.result()
+                except Exception as exc:
+                    print('%r generated an exception in profile likelihood fits: %s' % ((k, direction), exc))
+                    values, rss, bound, crossed = [], [], np.nan, False
+                self.profiles[k]['Value'] += values
+                self.profiles[k]['RSS'] += rss
+                self.profile_intervals[k]['Lower' if direction == -1 else 'Upper'] = bound
+                self.profile_intervals[k]['Lower bounded' if direction == -1 else 'Upper bounded'] = crossed
+        for k in profiled_params:
+            order = np.argsort(self.profiles[k]['Value'])
+            self.profiles[k] = {key:list(np.array(v)[order]) for key, v in self.profiles[k].items()}
+
+        print('')
+        print(f'### Profile likelihood {100*confidence_level:g}% confidence intervals ###')
+        for k in profiled_params: # < and > mark interval ends the profile never reached
+            print(f"{k} = {self.opt_params[k].value} ({self.profile_interval_string(k)})")
+
+    def profile_interval_string(self, k):
+        lower = f"{'' if self.profile_intervals[k]['Lower bounded'] else '<'}{self.profile_intervals[k]['Lower']}"
+        upper = f"{'' if self.profile_intervals[k]['Upper bounded'] else '>'}{self.profile_intervals[k]['Upper']}"
+        return f"{lower}, {upper}"
+
+    @staticmethod
+    def profile_task(opt_params, profiled_param, direction, optimum_rss, rss_threshold, initial_step, max_steps, range_factor, min_method='leastsq'):
+        # Step one parameter away from the optimum and refit the others, starting each fit from the previous step. Positive parameters
+        # are stepped in log10 units, others relative to their optimal value. The step doubles while the RSS rises slowly and is halved
+        # and retried when a step overshoots the threshold by more than half the remaining distance. Returns the profiled values and
+        # RSS, the threshold crossing interpolated between the last two steps, and whether the threshold was crossed at all (if not,
+        # the interval end is the furthest value profiled, at the range factor, a parameter bound or after max_steps).
+        params = deepcopy(opt_params)
+        params[profiled_param].vary = False
+        opt_value = opt_params[profiled_param].value
+        log_steps = opt_value > 0
+        max_position = np.log10(range_factor) if log_steps else range_factor
+        position, step, last_rss = 0, initial_step, optimum_rss
+        values, rss = [], []
+        for x in range(max_steps):
+            trial_position = direction*min(np.abs(position) + step, max_position)
+            trial_value = opt_value*10**trial_position if log_steps else opt_value + trial_position*np.abs(opt_value)
+            trial_value = np.clip(trial_value, opt_params[profiled_param].min, opt_params[profiled_param].max)
+            trial_position = np.log10(trial_value/opt_value) if log_steps else (trial_value - opt_value)/np.abs(opt_value) # Position of a clipped value
+            params[profiled_param].value = trial_value
+            result = ErrorAnalysis.correlation_fit_task(params, min_method)
+            if (result.chisqr > rss_threshold + (rss_threshold - last_rss)/2) & (step > initial_step/16): # Overshot, take a shorter step
+                step = step/2
+                continue
+            values.append(trial_value)
+            rss.append(result.chisqr)
+            if result.chisqr >= rss_threshold:
+                crossing_position = position + (trial_position - position)*(rss_threshold - last_rss)/(result.chisqr - last_rss)
+                return values, rss, opt_value*10**crossing_position if log_steps else opt_value + crossing_position*np.abs(opt_value), True
+            if (trial_value == opt_params[profiled_param].min) | (trial_value == opt_params[profiled_param].max) | (np.abs(trial_position) >= max_position):
+                return values, rss, trial_value, False
+            for k in params:
+                if params[k].vary == True:
+                    params[k].value = result.params[k].value
+            if result.chisqr - last_rss < (rss_threshold - optimum_rss)/4:
+                step = 2*step
+            position, last_rss = trial_position, result.chisqr
+        return values, rss, values[-1] if len(values) > 0 else np.nan, False
+
+    def profile_likelihood_plots(self, sample_name):
+        pdf = make_pdf(f"output/{sample_name}_profile_likelihood.pdf")
+        for k in self.profiles.keys():
+            fig, ax = plt.subplots(1,1)
+            ax.plot(self.profiles[k]['Value'], self.profiles[k]['RSS'], 'o-', markersize=4, mec='k')
+            ax.axhline(self.profile_threshold, color='k', linestyle='--', linewidth=1)
+            ax.axvline(self.opt_params[k].value, color='k', linewidth=1)
+            if self.opt_params[k].value > 0:
+                ax.set_xscale('log')
+            ax.set_title(f"{k}: {self.opt_params[k].value} ({self.profile_interval_string(k)})")
+            ax.set_xlabel(k)
+            ax.set_ylabel('RSS')
+            fig.tight_layout()
+            pdf.savefig(fig)
+            plt.close(fig)
+        pdf.close()
+
+    def save_profile_likelihood_results(self, sample_name):
+        profile_results = {'Parameter':[], 'Opt Value':[], 'Lower':[], 'Upper':[], 'Lower bounded':[], 'Upper bounded':[], 'Confidence level':[]}
+        for k in self.profile_intervals.keys():
+            profile_results['Parameter'].append(k)
+            profile_results['Opt Value'].append(self.opt_params[k].value)
+            for key in ['Lower', 'Upper', 'Lower bounded', 'Upper bounded']:
+                profile_results[key].append(self.profile_intervals[k][key])
+            profile_results['Confidence level'].append(self.confidence_level)
+        pd.DataFrame(profile_results).to_csv(f"output/{sample_name}_profile_likelihood_intervals.csv", index=False)
+        profile_dfs = [pd.DataFrame(self.profiles[k]) for k in self.profiles.keys()]
+        pd.concat(profile_dfs, axis=1, keys=(self.profiles.keys())).to_csv(f"output/{sample_name}_profile_likelihood_values.csv", index=False)
+
+    def monte_carlo_adaptive_stopping(self, tolerance, minimum_iterations=100, check_interval=25, bootstrap_samples=200):
+        # Stop the Monte Carlo run once the error estimate of every varied parameter is known to within tolerance (relative),
+        # checked every check_interval replicates from minimum_iterations on. monte_carlo_iterations becomes the maximum.
+        self.adaptive_tolerance = tolerance
+        self.minimum_iterations = minimum_iterations
+        self.check_interval = check_interval
+        self.bootstrap_samples = bootstrap_samples
+
+    def reset_monte_carlo_convergence(self):
+        self.monte_carlo_trace = []
+        self.converged_iterations = None
+        self.welford_count = 0
+        self.welford_mean = np.zeros(len(self.monte_carlo_parameters))
+        self.welford_m2 = np.zeros(len(self.monte_carlo_parameters))
+
+    def monte_carlo_convergence(self, replicate_results):
+        # The stopping rule only looks at the contiguous run of finished replicates 0, 1, 2, ..., so where a run stops depends on the
+        # seed but not on the order in which workers finish. Running mean/variance of each parameter are updated with Welford's method,
+        # and at every check the precision of each error (std) estimate is taken from a bootstrap of the replicates so far.
+        if self.adaptive_tolerance is None:
+            return False
+        parameters = list(self.monte_carlo_parameters.keys())
+        while self.welford_count in replicate_results:
+            values = np.array([replicate_results[self.welford_count][k] for k in parameters])
+            self.welford_count += 1
+            delta = values - self.welford_mean
+            self.welford_mean += delta/self.welford_count
+            self.welford_m2 += delta*(values - self.welford_mean)
+            if (self.welford_count >= self.minimum_iterations) & (self.welford_count % self.check_interval == 0):
+                replicate_values = np.array([[replicate_results[x][k] for k in parameters] for x in range(self.welford_count)])
+                bootstrap_rng = np.random.default_rng(np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=(self.welford_count, 1))) # Separate from the replicate streams
+                resamples = bootstrap_rng.integers(0, self.welford_count, (self.bootstrap_samples, self.welford_count))
+                bootstrap_errors = np.std(replicate_values[resamples], axis=1)
+                errors = np.sqrt(self.welford_m2/self.welford_count)
+                relative_precision = np.std(bootstrap_errors, axis=0)/np.where(errors > 0, errors, np.inf)
+                self.monte_carlo_trace.append({'Iterations':self.welford_count, **{f"{k} error":errors[i] for i, k in enumerate(parameters)}, 
+                **{f"{k} relative precision":relative_precision[i] for i, k in enumerate(parameters)}})
+                if np.all(relative_precision <= self.adaptive_tolerance):
+                    self.converged_iterations = self.welford_count
+                    return True
+        return False
+
+    def report_monte_carlo_convergence(self, converged):
+        print('')
+        print('### Monte Carlo convergence ###')
+        for step in self.monte_carlo_trace:
+            print(f"{step['Iterations']} iterations: " + ', '.join([f"{k} = {v:.3e}" for k, v in step.items() if k != 'Iterations']))
+        if converged:
+            print(f"Error estimates converged to a relative precision of {self.adaptive_tolerance} after {self.converged_iterations} iterations.")
+        else:
+            print(f"Error estimates did not converge to a relative precision of {self.adaptive_tolerance} within {self.monte_carlo_iterations} iterations.")
+
+    def save_monte_carlo_convergence(self, sample_name):
+        pd.DataFrame(self.monte_carlo_trace).to_csv(f"output/{sample_name}_MonteCarlo_convergence.csv", index=False)
+
     def monte_carlo_parameter_dictionary(self):
         self.monte_carlo_parameters = {k:[] for k in self.opt_params.keys() if self.opt_params[k].vary == True}
         self.monte_carlo_errors = {f"{k} error":None for k in self.opt_params.keys() if self.opt_params[k].vary == True}
 
     @staticmethod
-    def parallel_fit_task(initial_guess_params, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, min_method='leastsq'):
-        minimizer_result = minimize(objective_wrapper, initial_guess_params, method = min_method, args=(experiment, kinetic_model, hybridization_model, simulate_full_model))
+    def parallel_fit_task(initial_guess_params, experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, objective_jacobian=None, min_method='leastsq'):
+        jacobian_kws = {'Dfun': objective_jacobian} if objective_jacobian is not None else {} # Analytic Jacobian from the model sensitivities
+        minimizer_result = minimize(objective_wrapper, initial_guess_params, method = min_method, args=(experiment, kinetic_model, hybridization_model, simulate_full_model), **jacobian_kws)
         return minimizer_result
     
     @staticmethod
-    def monte_carlo_parallel_fit_task(initial_guess_params, perfect_experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, rmsd, min_method='leastsq'):
-        perturbed_experiment = deepcopy(perfect_experiment)
-        for i,x in enumerate(perturbed_experiment.fret):
-            perturbed_experiment.fret[i] = x + np.random.RandomState().normal(scale=rmsd,size=np.size(x, 0))
+    def correlation_fit_task(initial_guess_params, min_method='leastsq'):
+        # Fit one correlation grid point with the experiment and models of this worker
+        monte_carlo_worker_state['Kinetic model'].carried_sensitivities = ()
+        return ErrorAnalysis.parallel_fit_task(initial_guess_params, monte_carlo_worker_state['Experiment'], monte_carlo_worker_state['Kinetic model'], 
+        monte_carlo_worker_state['Hybridization model'], monte_carlo_worker_state['Simulate'], monte_carlo_worker_state['Objective'], 
+        monte_carlo_worker_state['Jacobian'], min_method)
+
+    @staticmethod
+    def monte_carlo_worker_initializer(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, objective_jacobian):
+        monte_carlo_worker_state.update({'Experiment':experiment, 'Kinetic model':kinetic_model, 'Hybridization model':hybridization_model, 
+        'Simulate':simulate_full_model, 'Objective':objective_wrapper, 'Jacobian':objective_jacobian})
+
+    @staticmethod
+    def monte_carlo_chunk_task(initial_guess_params, replicate_indices, entropy, rmsd, min_method='leastsq'):
+        # Fit each replicate in the chunk with the experiment and models of this worker, returns {replicate index: {parameter: value}}
+        results = {}
+        for x in replicate_indices:
+            perturbed_minimizer_result = ErrorAnalysis.monte_carlo_parallel_fit_task(initial_guess_params, monte_carlo_worker_state['Experiment'], 
+            monte_carlo_worker_state['Kinetic model'], monte_carlo_worker_state['Hybridization model'], monte_carlo_worker_state['Simulate'], 
+            monte_carlo_worker_state['Objective'], rmsd, np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(int(x),))), 
+            monte_carlo_worker_state['Jacobian'], min_method)
+            results[int(x)] = {k:perturbed_minimizer_result.params[k].value for k in perturbed_minimizer_result.params}
+        return results
+
+    @staticmethod
+    def monte_carlo_parallel_fit_task(initial_guess_params, perfect_experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, rmsd, rng, objective_jacobian=None, min_method='leastsq'):
+        perturbed_experiment = copy(perfect_experiment) # Only the FRET data changes, share everything else with the perfect experiment
+        perturbed_experiment.fret = [x + rng.normal(scale=rmsd,size=np.size(x, 0)) for x in perfect_experiment.fret]
+        hybridization_model.experimental_fret = perturbed_experiment.fret # Baseline params are solved against the perturbed data too
+        hybridization_model.setup_experimental_fret()
+        kinetic_model.carried_sensitivities = () # Start every replicate from the same model state, whatever this worker fitted before
+        jacobian_kws = {'Dfun': objective_jacobian} if objective_jacobian is not None else {}
         perturbed_minimizer_result = minimize(objective_wrapper, initial_guess_params, method = min_method, 
-        args=(perturbed_experiment, kinetic_model, hybridization_model, simulate_full_model))
+        args=(perturbed_experiment, kinetic_model, hybridization_model, simulate_full_model), **jacobian_kws)
         return perturbed_minimizer_result
 
     def parameter_correlation_surfaces(self, sample_name):
         pdf = make_pdf(f"./output/{sample_name}_parameter_correlation_surfaces.pdf")
 
         for param_pairs in self.correlation_pairs.keys():
-            param_pair_values = self.correlation_pairs[param_pairs]
+            param_pair_values = {k:self.correlation_pairs[param_pairs][k] for k in param_pairs.split(',') + ['RSS', 'Fit results', 'Result order']}
             sorted_values = sorted(zip(*[param_pair_values[k] for k in param_pair_values]), key=lambda x: x[-1])
             sorted_param_pair_values = {k: [v[i] for v in sorted_values] for i, k in enumerate(param_pair_values)}
 
@@ -132,12 +724,18 @@ class ErrorAnalysis():
             y = sorted_param_pair_values[param_pairs.split(',')[1]]
             z = sorted_param_pair_values['RSS']
 
-            xgrid = np.reshape(x, (self.points, self.points))
-            ygrid = np.reshape(y, (self.points, self.points))
-            zgrid = np.reshape(z, (self.points, self.points)) # Reduced delta RSS
+            if self.refinement_levels > 0: # Unstructured points of an adaptive surface, interpolated in log space like the grid
+                xgrid, ygrid, zgrid = self.make_grid_data(np.log10(x), np.log10(y), z)
+                xgrid, ygrid = 10**xgrid, 10**ygrid
+            else:
+                xgrid = np.reshape(x, (self.points, self.points))
+                ygrid = np.reshape(y, (self.points, self.points))
+                zgrid = np.reshape(z, (self.points, self.points)) # Reduced delta RSS
 
             fig, ax = plt.subplots(1, 1)
             a = ax.contourf(xgrid, ygrid, zgrid, levels=100, cmap='turbo')
+            if self.refinement_levels > 0:
+                ax.plot(x, y, '.', markersize=2, color='k')
             ax.plot(self.opt_params[param_pairs.split(',')[0]].value, self.opt_params[param_pairs.split(',')[1]].value, 'X', markersize=10, mew=1, mec='k', mfc='w')
             cbar = fig.colorbar(a, format='%.2e')
             cbar.ax.set_title('RSS', pad=10)
@@ -151,7 +749,7 @@ class ErrorAnalysis():
         pdf.close()
 
     def monte_carlo_distributions(self, sample_name):
-        pdf = make_pdf(f"output/{sample_name}_MonteCarlo_parameter_distributions_{self.monte_carlo_iterations}_iterations.pdf")
+        pdf = make_pdf(f"output/{sample_name}_{self.sampling_name}_parameter_distributions_{self.monte_carlo_iterations}_iterations.pdf")
         for k in self.monte_carlo_parameters.keys():
             fig, ax = plt.subplots(1,1)
             ax.hist(np.log10(self.monte_carlo_parameters[k]), bins=int(np.sqrt(self.monte_carlo_iterations)), linewidth=0.5, ec='k')
@@ -196,6 +794,6 @@ class ErrorAnalysis():
             monte_carlo_results['Opt Value'].append(self.opt_params[k1].value)
             monte_carlo_results['Error'].append(self.monte_carlo_errors[k2])
         monte_carlo_results = pd.DataFrame(monte_carlo_results)
-        monte_carlo_df.to_csv(f"output/{sample_name}_MonteCarlo_values_{self.monte_carlo_iterations}_iterations.csv", index=False)
-        monte_carlo_results.to_csv(f"output/{sample_name}_MonteCarlo_errors_{self.monte_carlo_iterations}_iterations.csv", index=False)
+        monte_carlo_df.to_csv(f"output/{sample_name}_{self.sampling_name}_values_{self.monte_carlo_iterations}_iterations.csv", index=False)
+        monte_carlo_results.to_csv(f"output/{sample_name}_{self.sampling_name}_errors_{self.monte_carlo_iterations}_iterations.csv", index=False)
         
@@ -3,16 +3,68 @@
 
 import sys
 import numpy as np
-from utils import load_data, setup_parameters, write_optimal_parameter_csv
+from utils import load_data, setup_parameters, write_optimal_parameter_csv, write_deviation_csv, write_solver_tuning_csv, load_global_datasets
 from experiment import FretExperiment
-from models import generate_model_objects, simulate_full_model, calculate_residuals_simulate_best_fit_data
+from models import generate_model_objects, simulate_full_model, calculate_residuals_simulate_best_fit_data, pseudo_first_order_deviation, auto_tune_solver
 from plotting import PlotHandler
-from minimization import objective_wrapper, residuals, sum_of_squared_residuals
+from minimization import objective_wrapper, objective_jacobian, residuals, sum_of_squared_residuals, multi_start_minimize, GlobalFit
 from lmfit import Parameters, minimize, report_fit
 from error_analysis import ErrorAnalysis
 import os
 
 
+def report_reduced_model_deviation(experiment, params, config_params):
+    # Check the closed form enzyme excess solution against the full BDF solution at the given parameters
+    for name, file_name, model_deviation in [('Pseudo-first-order', 'pseudo_first_order', pseudo_first_order_deviation)]:
+        deviations = model_deviation(experiment, params, config_params)
+        if len(deviations['Enzyme']) > 0:
+            print(f'\n### {name} deviation from full kinetic model ###')
+            for e, rna, pop_dev, af_dev in zip(deviations['Enzyme'], deviations['RNA'], deviations['Population deviation'], deviations['Annealed fraction deviation']):
+                print(f"[E] = {e} M, [RNA] = {rna} M: max RNA population deviation = {pop_dev:.2e}, max annealed fraction deviation = {af_dev:.2e}")
+            write_deviation_csv(deviations, f"{config_params['Sample name']}_{file_name}_deviation.csv")
+
+
+def report_conservation_drift(experiment, params, config_params):
+    # Change of the conserved enzyme, RNA and nucleotide totals over the integration at the given parameters
+    kinetic_model, hybridization_model = generate_model_objects(experiment, config_params['Modeling parameters']['Kinetic model'], config_params['Modeling parameters'])
+    simulate_full_model(params, kinetic_model, hybridization_model)
+    kinetic_model.close_worker_pool()
+    print(f"\nMaximum conservation drift of the kinetic model = {np.max(kinetic_model.conservation_drift()):.2e} (fraction of RNA)")
+
+
+def tune_solver(experiment, params, config_params, jacobian_func):
+    # Time the integrators on the initial guesses with the sensitivities the fit carries, the models generated from here on use the choice
+    if config_params['Modeling parameters'].get('Integrator', 'BDF') != 'Auto':
+        return None
+    sensitivities = [k for k in params if params[k].vary] if jacobian_func is not None else ()
+    return auto_tune_solver(experiment, params, config_params, sensitivities)
+
+
+def report_solver_tuning(tuning, file_name):
+    if tuning is not None:
+        (integrator, tolerance), timings = tuning
+        print('\n### Integrator auto-tune ###')
+        print(f"Chosen integrator = {integrator} with the {tolerance} tolerance preset")
+        for integ, tol, elapsed, error, status in zip(timings['Integrator'], timings['Tolerance preset'], timings['Time'], timings['Annealed fraction error'], timings['Status']):
+            if status in ['Timed out', 'Failed']:
+                print(f"{integ} {tol}: {status.lower()}")
+            else:
+                print(f"{integ} {tol}: simulation time = {elapsed:.3g} s, max annealed fraction error = {error:.2e} ({status.lower()})")
+        write_solver_tuning_csv(timings, file_name)
+
+
+def analytic_jacobian(config_params, min_method):
+    # Sensitivity based Jacobian for the least squares minimizers, otherwise lmfit falls back to finite differences
+    if config_params['Modeling parameters'].get('Analytic Jacobian', False) and min_method in ['leastsq', 'least_squares']:
+        return objective_jacobian
+    return None
+
+
+def jacobian_kws(jacobian_func):
+    # lmfit only accepts Dfun when there is one
+    return {'Dfun': jacobian_func} if jacobian_func is not None else {}
+
+
 def main():
 
     # Get data, set up fit parameters, constants, etc.
@@ -20,6 +72,7 @@ def main():
     hybridization_params, initial_guess_params, varied_params, opt_params = setup_parameters(config_params, Parameters())
 
     minimizer_params = []
+    global_fit = None
     experiments = []
     kinetic_models = []
     hybridization_models = []
@@ -29,20 +82,69 @@ def main():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    # Global fit of several datasets with shared and local parameters
+    if (config_params['Modeling parameters']['Fit'] == True) & (config_params.get('Global fit', {}).get('Run', False) == True):
+        min_method = config_params['Modeling parameters']['Minimizer']
+        tunings = []
+
+        print("\n### Running global data fit ###")
+        dataset_names, datasets = load_global_datasets(config_params, hybridization_params)
+        for dataset_data, dataset_hybridization_params in datasets:
+            experiment = FretExperiment(dataset_data, dataset_hybridization_params)
+            tunings.append(tune_solver(experiment, initial_guess_params, config_params, analytic_jacobian(config_params, min_method)))
+            kinetic_model, hybridization_model = generate_model_objects(experiment, config_params['Modeling parameters']['Kinetic model'], config_params['Modeling parameters'])
+            experiments.append(experiment)
+            kinetic_models.append(kinetic_model)
+            hybridization_models.append(hybridization_model)
+        global_fit = GlobalFit(experiments, kinetic_models, hybridization_models, simulate_full_model, dataset_names, config_params['Global fit'].get('Local parameters', []), 
+        config_params['Global fit'].get('Worker processes', 1))
+        global_jacobian = global_fit.jacobian if analytic_jacobian(config_params, min_method) is not None else None
+
+        minimizer_result = minimize(global_fit.objective, global_fit.global_parameters(initial_guess_params), method = min_method, **jacobian_kws(global_jacobian))
+        global_fit.close_worker_pool()
+        for kinetic_model in kinetic_models:
+            kinetic_model.close_worker_pool()
+        report_fit(minimizer_result)
+        for dataset_name, tuning in zip(dataset_names, tunings):
+            report_solver_tuning(tuning, f"{config_params['Sample name']}_{dataset_name}_solver_tuning.csv")
+        for i, experiment in enumerate(experiments):
+            minimizer_params.append(global_fit.dataset_parameters(minimizer_result.params, i))
+            report_reduced_model_deviation(experiment, minimizer_params[i], config_params)
+            report_conservation_drift(experiment, minimizer_params[i], config_params)
+
+        param_units = [config_params['Modeling parameters']['Fit parameters'][global_fit.base_name(k)]['Units'] for k in minimizer_result.params]
+        resids, normalized_resids, best_kin_models, best_hybr_models = calculate_residuals_simulate_best_fit_data(experiments, minimizer_params, config_params, residuals)
+        try:
+            write_optimal_parameter_csv(minimizer_result.params, param_units, config_params['Optimal fit parameter file'])
+        except Exception as e:
+            print(e)
+
     # Run fit, either sequential fitting of individual replicates or average of replicates
-    if config_params['Modeling parameters']['Fit'] == True:
+    elif config_params['Modeling parameters']['Fit'] == True:
         min_method = config_params['Modeling parameters']['Minimizer']
+        jacobian_func = analytic_jacobian(config_params, min_method)
 
         print("\n### Running data fits ###")
         experiment = FretExperiment(data, hybridization_params)
-        kinetic_model, hybridization_model = generate_model_objects(experiment, config_params['Modeling parameters']['Kinetic model'])
+        tuning = tune_solver(experiment, initial_guess_params, config_params, jacobian_func)
+        kinetic_model, hybridization_model = generate_model_objects(experiment, config_params['Modeling parameters']['Kinetic model'], config_params['Modeling parameters'])
         experiments.append(experiment)
         kinetic_models.append(kinetic_model)
         hybridization_models.append(hybridization_model)
         
-        minimizer_result = minimize(objective_wrapper, initial_guess_params, method = min_method, args=(experiment, kinetic_model, hybridization_model, simulate_full_model))
+        multi_start_params = config_params['Modeling parameters'].get('Multi-start', {})
+        if multi_start_params.get('Run', False) == True: # Best of several local fits from Latin hypercube starts
+            minimizer_result, minima = multi_start_minimize(initial_guess_params, experiment, kinetic_model, hybridization_model, simulate_full_model, min_method, jacobian_func, 
+            multi_start_params.get('Starts', 16), multi_start_params.get('Seed'), multi_start_params.get('Decades', 2), multi_start_params.get('Abandon factor', 10), multi_start_params.get('Abandon after', 20))
+            minima.to_csv(f"output/{config_params['Sample name']}_multi_start_minima.csv", index=False)
+        else:
+            minimizer_result = minimize(objective_wrapper, initial_guess_params, method = min_method, args=(experiment, kinetic_model, hybridization_model, simulate_full_model), **jacobian_kws(jacobian_func))
+        kinetic_model.close_worker_pool()
         report_fit(minimizer_result)
+        report_solver_tuning(tuning, f"{config_params['Sample name']}_solver_tuning.csv")
         minimizer_params.append(minimizer_result.params)
+        report_reduced_model_deviation(experiment, minimizer_result.params, config_params)
+        report_conservation_drift(experiment, minimizer_result.params, config_params)
 
         param_units = [config_params['Modeling parameters']['Fit parameters'][k]['Units'] for k in config_params['Modeling parameters']['Fit parameters'].keys()]
 
@@ -61,11 +163,13 @@ def main():
         print('\n### Running data simulation ###')
         # Simulate best fit data and plot
         experiment = FretExperiment(data, hybridization_params)
-        kinetic_model, hybridization_model = generate_model_objects(experiment, config_params['Modeling parameters']['Kinetic model'])
+        kinetic_model, hybridization_model = generate_model_objects(experiment, config_params['Modeling parameters']['Kinetic model'], config_params['Modeling parameters'])
         experiments.append(experiment)
         kinetic_models.append(kinetic_model)
         hybridization_models.append(hybridization_model)
         minimizer_params.append(initial_guess_params)
+        report_reduced_model_deviation(experiment, initial_guess_params, config_params)
+        report_conservation_drift(experiment, initial_guess_params, config_params)
         resids, normalized_resids, best_kin_models, best_hybr_models = calculate_residuals_simulate_best_fit_data(experiments, minimizer_params, config_params, residuals)
         print(f'RSS for simulated data: {sum_of_squared_residuals(resids[0])}')
     
@@ -83,21 +187,61 @@ def main():
     plot_handler.run_plots()
 
     # Error analysis
+    if global_fit is not None: # Error estimation works on single dataset fits
+        print('\nError estimation is not run for global fits, fit the datasets separately for error estimates.')
+        return
+
+    if config_params['Modeling parameters']['Error estimation'].get('Linearized covariance', {}).get('Run', False) == True:
+        linearized_params = config_params['Modeling parameters']['Error estimation']['Linearized covariance']
+        error_analyzer = ErrorAnalysis(minimizer_result.params, seed=linearized_params.get('Seed'))
+        error_analyzer.linearized_covariance(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_jacobian, minimizer_result.chisqr, 
+        linearized_params.get('Samples', 0))
+        error_analyzer.save_linearized_covariance(config_params['Sample name'])
+
     if config_params['Modeling parameters']['Error estimation']['Monte Carlo']['Run'] == True:
         monte_carlo_iterations = config_params['Modeling parameters']['Error estimation']['Monte Carlo']['Iterations']
         rmsd = np.sqrt(minimizer_result.chisqr/minimizer_result.ndata)
-        error_analyzer = ErrorAnalysis(minimizer_result.params, monte_carlo_iterations, rmsd, None, None)
+        error_analyzer = ErrorAnalysis(minimizer_result.params, monte_carlo_iterations, rmsd, None, None, config_params['Modeling parameters']['Error estimation']['Monte Carlo'].get('Seed'))
         error_analyzer.monte_carlo_parameter_dictionary()
-        error_analyzer.monte_carlo_fits(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper)
+        monte_carlo_params = config_params['Modeling parameters']['Error estimation']['Monte Carlo']
+        if monte_carlo_params.get('Adaptive', False): # Iterations is then the maximum number of iterations
+            error_analyzer.monte_carlo_adaptive_stopping(monte_carlo_params['Tolerance'], monte_carlo_params['Minimum iterations'], monte_carlo_params['Check interval'])
+        error_analyzer.monte_carlo_fits(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, analytic_jacobian(config_params, 'leastsq'), 
+        checkpoint_file=f"output/{config_params['Sample name']}_MonteCarlo_checkpoint.csv", resume=config_params['Modeling parameters']['Error estimation'].get('Resume', False))
         error_analyzer.monte_carlo_distributions(config_params['Sample name'])
         error_analyzer.save_monte_carlo_results(config_params['Sample name'])
+        if monte_carlo_params.get('Adaptive', False):
+            error_analyzer.save_monte_carlo_convergence(config_params['Sample name'])
+
+    if config_params['Modeling parameters']['Error estimation'].get('MCMC', {}).get('Run', False) == True:
+        mcmc_params = config_params['Modeling parameters']['Error estimation']['MCMC']
+        rmsd = np.sqrt(minimizer_result.chisqr/minimizer_result.ndata)
+        error_analyzer = ErrorAnalysis(minimizer_result.params, None, rmsd, None, None, mcmc_params.get('Seed'))
+        error_analyzer.monte_carlo_parameter_dictionary()
+        error_analyzer.mcmc_sampling(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, mcmc_params.get('Walkers'), 
+        mcmc_params.get('Steps', 5000), mcmc_params.get('Check interval', 100))
+        error_analyzer.monte_carlo_distributions(config_params['Sample name'])
+        error_analyzer.save_monte_carlo_results(config_params['Sample name'])
+        error_analyzer.save_mcmc_diagnostics(config_params['Sample name'])
+
+    if config_params['Modeling parameters']['Error estimation'].get('Profile likelihood', {}).get('Run', False) == True:
+        profile_params = config_params['Modeling parameters']['Error estimation']['Profile likelihood']
+        error_analyzer = ErrorAnalysis(minimizer_result.params)
+        error_analyzer.profile_likelihood_fits(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, analytic_jacobian(config_params, 'leastsq'), 
+        minimizer_result.chisqr, profile_params.get('Confidence level', 0.95), profile_params.get('Initial step', 0.02), profile_params.get('Maximum steps', 50), profile_params.get('Parameter range factor', 100))
+        error_analyzer.profile_likelihood_plots(config_params['Sample name'])
+        error_analyzer.save_profile_likelihood_results(config_params['Sample name'])
 
     if config_params['Modeling parameters']['Error estimation']['Error surfaces']['Run'] == True:
         range_factor = config_params['Modeling parameters']['Error estimation']['Error surfaces']['Parameter range factor']
         points = config_params['Modeling parameters']['Error estimation']['Error surfaces']['Points']
         error_analyzer = ErrorAnalysis(minimizer_result.params, None, None, range_factor, points)
+        error_surface_params = config_params['Modeling parameters']['Error estimation']['Error surfaces']
+        if error_surface_params.get('Adaptive', False): # Points is then the starting grid
+            error_analyzer.adaptive_correlation_surfaces(error_surface_params['Fit budget'], error_surface_params.get('Refinement levels', 3), error_surface_params.get('Confidence level', 0.95))
         error_analyzer.correlation_pairs()
-        error_analyzer.parameter_correlation_fits(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper)
+        error_analyzer.parameter_correlation_fits(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_wrapper, analytic_jacobian(config_params, 'leastsq'), 
+        checkpoint_file=f"output/{config_params['Sample name']}_parameter_correlation_checkpoint.csv", resume=config_params['Modeling parameters']['Error estimation'].get('Resume', False))
         error_analyzer.parameter_correlation_surfaces(config_params['Sample name'])
         error_analyzer.save_parameter_correlation_results(config_params['Sample name'])
 
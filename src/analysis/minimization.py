@@ -1,13 +1,45 @@
 import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count, Value
+from scipy.stats import qmc
+from lmfit import minimize, Parameters
+from copy import deepcopy
+from tqdm import tqdm
+import re
+
+
+multi_start_worker_state = {} # Experiment, models and functions of a multi-start worker process, set once by the pool initializer
+global_fit_worker_state = {} # Experiments and models of all datasets in a global fit worker process, set once by the pool initializer
 
 
 def objective_wrapper(params, experiment, kinetic_model, hybridization_model, simulate_full_model):
-    kinetic_model, hybridization_model = simulate_full_model(params, kinetic_model, hybridization_model)
+    kinetic_model, hybridization_model = simulate_full_model(params, kinetic_model, hybridization_model, kinetic_model.carried_sensitivities)
     
     resid = residuals(experiment.fret, hybridization_model.fret)
     concat_resid = np.concatenate(resid, axis=None)
     return concat_resid
 
+def objective_jacobian(params, experiment, kinetic_model, hybridization_model, simulate_full_model):
+    # Analytic Jacobian of objective_wrapper for lmfit.minimize(..., Dfun=objective_jacobian), one column per varied parameter in lmfit order.
+    # Forward sensitivities of the kinetic model and the dGo/alpha derivatives of the duplex equilibria are carried through the baseline fit in the same simulation,
+    # instead of the p + 1 simulations of a finite difference Jacobian. Parameters the model does not depend on get zero columns.
+    # The minimizer asks for the Jacobian at the point it last evaluated, so after the first call objective_wrapper carries the
+    # sensitivities along and they are reused here rather than solving the kinetics twice.
+    varied_params = [k for k in params if params[k].vary]
+    sensitivities = tuple(k for k in varied_params if k in kinetic_model.rate_constants + hybridization_model.thermodynamic_params)
+    simulated_params = kinetic_model.simulated_rate_constants + [hybridization_model.dGo, hybridization_model.alpha]
+    if (kinetic_model.carried_sensitivities != sensitivities) or (simulated_params != [params[k].value for k in kinetic_model.rate_constants + hybridization_model.thermodynamic_params]):
+        kinetic_model.carried_sensitivities = sensitivities
+        kinetic_model, hybridization_model = simulate_full_model(params, kinetic_model, hybridization_model, sensitivities)
+
+    jacobian = np.zeros((sum([len(fret) for fret in experiment.fret]), len(varied_params)))
+    if len(sensitivities) > 0:
+        fret_sensitivities = np.concatenate(hybridization_model.fret_sensitivities, axis=0)
+        for j, k in enumerate(sensitivities):
+            jacobian[:, varied_params.index(k)] = -fret_sensitivities[:, j] # Residuals are data - model
+    return jacobian
+
 def residuals(ydata, predicted):
     resid = []
     for i, v in enumerate(ydata):
@@ -18,3 +50,171 @@ def sum_of_squared_residuals(residuals):
     resid = np.concatenate(residuals, axis=None)
     rss = np.sum(np.square(resid))
     return rss
+
+def latin_hypercube_starts(params, starts, seed=None, decades=2):
+    # Starting points for the varied parameters from a Latin hypercube, in log10 space for positive parameters. Each parameter spans
+    # +/- decades around its initial guess (+/- decades times its magnitude if not positive), cut to its bounds. The first start is the initial guess.
+    varied_params = [k for k in params if params[k].vary]
+    lower, upper = [], []
+    for k in varied_params:
+        if params[k].value > 0:
+            lower.append(max(np.log10(params[k].value) - decades, np.log10(params[k].min) if params[k].min > 0 else -np.inf))
+            upper.append(min(np.log10(params[k].value) + decades, np.log10(params[k].max)))
+        else:
+            lower.append(max(params[k].value - decades*max(np.abs(params[k].value), 1), params[k].min))
+            upper.append(min(params[k].value + decades*max(np.abs(params[k].value), 1), params[k].max))
+    samples = qmc.scale(qmc.LatinHypercube(d=len(varied_params), seed=np.random.default_rng(seed)).random(starts - 1), lower, upper)
+    start_params = [deepcopy(params)]
+    for sample in samples:
+        start = deepcopy(params)
+        for i, k in enumerate(varied_params):
+            start[k].value = 10**sample[i] if params[k].value > 0 else sample[i]
+        start_params.append(start)
+    return start_params
+
+def multi_start_worker_initializer(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_jacobian, best_rss, abandon_factor, abandon_after):
+    multi_start_worker_state.update({'Experiment':experiment, 'Kinetic model':kinetic_model, 'Hybridization model':hybridization_model, 
+    'Simulate':simulate_full_model, 'Jacobian':objective_jacobian, 'Best RSS':best_rss, 'Abandon factor':abandon_factor, 'Abandon after':abandon_after})
+
+def abandon_losing_start(params, iteration, resid, *args, **kws):
+    # lmfit iteration callback, stops a start whose RSS is still abandon_factor times the best finished fit after abandon_after evaluations
+    return (iteration >= multi_start_worker_state['Abandon after']) & (np.sum(np.square(resid)) > multi_start_worker_state['Abandon factor']*multi_start_worker_state['Best RSS'].value)
+
+def multi_start_fit_task(start, min_method):
+    multi_start_worker_state['Kinetic model'].carried_sensitivities = ()
+    jacobian_kws = {'Dfun': multi_start_worker_state['Jacobian']} if multi_start_worker_state['Jacobian'] is not None else {}
+    return minimize(objective_wrapper, start, method = min_method, args=(multi_start_worker_state['Experiment'], multi_start_worker_state['Kinetic model'], 
+    multi_start_worker_state['Hybridization model'], multi_start_worker_state['Simulate']), iter_cb=abandon_losing_start, **jacobian_kws)
+
+def multi_start_minimize(params, experiment, kinetic_model, hybridization_model, simulate_full_model, min_method='leastsq', objective_jacobian=None, 
+starts=16, seed=None, decades=2, abandon_factor=10, abandon_after=20, workers=None):
+    # Local fits from Latin hypercube starting points on a process pool. Starts still far above the best finished fit after abandon_after
+    # evaluations are abandoned. Returns the best result and a table of the distinct minima found, ranked by RSS.
+    maxParallelProcesses = max(cpu_count() - 1, 1) if workers is None else workers
+    print('')
+    print('### Running {} multi-start fits using {} CPU cores. ###'.format(starts, maxParallelProcesses))
+    start_params = latin_hypercube_starts(params, starts, seed, decades)
+    best_rss = Value('d', np.inf)
+    results = {}
+    with ProcessPoolExecutor(max_workers = maxParallelProcesses, initializer=multi_start_worker_initializer, 
+    initargs=(experiment, kinetic_model, hybridization_model, simulate_full_model, objective_jacobian, best_rss, abandon_factor, abandon_after)) as parallelExecution:
+        future_results = {parallelExecution.submit(multi_start_fit_task, start, min_method):x for x, start in enumerate(start_params)}
+        for future in tqdm(as_completed(future_results), total=len(future_results), desc="Multi-start progress"):
+            x = future_results[future]
+            try:
+                result = future.result()
+            except Exception as exc:
+                print('Start %r generated an exception in multi-start fits: %s' % (x, exc))
+            else:
+                results[x] = result
+                if (not result.aborted) and (result.chisqr < best_rss.value):
+                    best_rss.value = result.chisqr
+
+    finished = sorted([x for x in results if not results[x].aborted], key=lambda x: results[x].chisqr)
+    if not finished: # Starts are only abandoned once another one has finished, so every start failed
+        raise RuntimeError(f'None of the {len(start_params)} multi-start fits finished ({len(start_params) - len(results)} failed, {len(results)} abandoned), see the exceptions above')
+    minima = distinct_minima([results[x] for x in finished], finished)
+    print('')
+    print(f'### Distinct minima from {len(finished)} finished starts ({len(results) - len(finished)} abandoned) ###')
+    print(minima.to_string(index=False))
+    return results[finished[0]], minima
+
+def distinct_minima(ranked_results, start_indices, decimals=2):
+    # Group fits (best first) whose varied parameters agree to decimals digits in log10 (positive values) or in value, one row per minimum
+    minima = []
+    for result, x in zip(ranked_results, start_indices):
+        varied_params = [k for k in result.params if result.params[k].vary]
+        location = tuple(np.round(np.log10(result.params[k].value), decimals) if result.params[k].value > 0 else np.round(result.params[k].value, decimals) for k in varied_params)
+        for minimum in minima:
+            if minimum['Location'] == location:
+                minimum['Starts'] += 1
+                break
+        else:
+            minima.append({'Location':location, 'RSS':result.chisqr, 'Starts':1, 'Best start':x, **{k:result.params[k].value for k in varied_params}})
+    minima_df = pd.DataFrame(minima).drop(columns='Location')
+    minima_df.insert(0, 'Rank', np.arange(1, len(minima_df) + 1))
+    return minima_df
+
+def global_fit_worker_initializer(experiments, kinetic_models, hybridization_models, simulate_full_model):
+    global_fit_worker_state.update({'Experiments':experiments, 'Kinetic models':kinetic_models, 'Hybridization models':hybridization_models, 'Simulate':simulate_full_model})
+
+def global_dataset_task(i, params, jacobian=False):
+    # Residuals (or their Jacobian) of dataset i with the models of this worker
+    args = (global_fit_worker_state['Experiments'][i], global_fit_worker_state['Kinetic models'][i], global_fit_worker_state['Hybridization models'][i], global_fit_worker_state['Simulate'])
+    return objective_jacobian(params, *args) if jacobian else objective_wrapper(params, *args)
+
+
+class GlobalFit():
+    # Several experiments fitted at once. Shared parameters are common to all datasets, local parameters get one copy per dataset
+    # named {parameter}_{dataset}. Every objective evaluation simulates each dataset with its own parameters and concatenates the
+    # residuals. With workers > 1 the datasets are simulated in parallel, each always in the same worker process so its kinetics
+    # cache and carried sensitivities stay with it.
+    def __init__(self, experiments, kinetic_models, hybridization_models, simulate_full_model, dataset_names, local_params=(), workers=1):
+        self.experiments = experiments
+        self.kinetic_models = kinetic_models
+        self.hybridization_models = hybridization_models
+        self.simulate_full_model = simulate_full_model
+        self.dataset_names = [re.sub(r'\W', '_', name) for name in dataset_names] # Valid lmfit parameter names
+        self.local_params = list(local_params)
+        self.workers = min(workers, len(experiments))
+        self.pools = None
+
+    def global_name(self, k, i):
+        return f"{k}_{self.dataset_names[i]}" if k in self.local_params else k
+
+    def base_name(self, global_name):
+        for k in self.local_params:
+            for name in self.dataset_names:
+                if global_name == f"{k}_{name}":
+                    return k
+        return global_name
+
+    def global_parameters(self, params):
+        global_params = Parameters()
+        for k in params:
+            for i in (range(len(self.experiments)) if k in self.local_params else [0]):
+                global_params.add(self.global_name(k, i), value=params[k].value, vary=params[k].vary, min=params[k].min, max=params[k].max)
+        return global_params
+
+    def dataset_parameters(self, global_params, i):
+        # Parameters of dataset i under the model parameter names
+        params = Parameters()
+        for name in global_params:
+            k = self.base_name(name)
+            if k not in params:
+                global_param = global_params[self.global_name(k, i)]
+                params.add(k, value=global_param.value, vary=global_param.vary, min=global_param.min, max=global_param.max)
+        return params
+
+    def evaluate(self, global_params, jacobian=False):
+        dataset_params = [self.dataset_parameters(global_params, i) for i in range(len(self.experiments))]
+        if self.workers > 1:
+            if self.pools is None: # One single process pool per worker, so dataset i always runs in the same process
+                self.pools = [ProcessPoolExecutor(max_workers=1, initializer=global_fit_worker_initializer, 
+                initargs=(self.experiments, self.kinetic_models, self.hybridization_models, self.simulate_full_model)) for w in range(self.workers)]
+            futures = [self.pools[i%self.workers].submit(global_dataset_task, i, dataset_params[i], jacobian) for i in range(len(self.experiments))]
+            return [future.result() for future in futures]
+        function = objective_jacobian if jacobian else objective_wrapper
+        return [function(dataset_params[i], self.experiments[i], self.kinetic_models[i], self.hybridization_models[i], self.simulate_full_model) for i in range(len(self.experiments))]
+
+    def objective(self, global_params):
+        return np.concatenate(self.evaluate(global_params), axis=None)
+
+    def jacobian(self, global_params):
+        # Block Jacobian for lmfit's Dfun: shared parameter columns collect every dataset's rows, local columns only their own dataset's
+        varied_params = [k for k in global_params if global_params[k].vary]
+        dataset_jacobians = self.evaluate(global_params, jacobian=True)
+        jacobian = np.zeros((sum([len(x) for x in dataset_jacobians]), len(varied_params)))
+        row = 0
+        for i, dataset_jacobian in enumerate(dataset_jacobians):
+            dataset_varied = [k for k in self.dataset_parameters(global_params, i) if global_params[self.global_name(k, i)].vary]
+            for j, k in enumerate(dataset_varied):
+                jacobian[row:row + len(dataset_jacobian), varied_params.index(self.global_name(k, i))] = dataset_jacobian[:, j]
+            row += len(dataset_jacobian)
+        return jacobian
+
+    def close_worker_pool(self):
+        if self.pools is not None:
+            for pool in self.pools:
+                pool.shutdown()
+            self.pools = None
@@ -1,16 +1,91 @@
 import numpy as np
 from scipy.integrate import solve_ivp
 from scipy.optimize import root
+from scipy.sparse import csc_matrix, issparse
+from scipy.linalg import expm
+from scipy.special import expit, logsumexp
+from functools import lru_cache
 from copy import deepcopy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
 
 
 class DistributiveDeadenylation():
-    def __init__(self, fret_experiment):
+    rate_constants = ['k1', 'km1', 'k2', 'km2', 'kcat'] # Parameters the kinetics depend on, forward sensitivities can be requested for any of these
+    ## (rtol, atol) of the solve for each tolerance preset, atol is relative to the RNA concentration. Largest annealed fraction
+    ## error against the reference preset for the CNOT7X conditions, at the optimal and at 20x faster rate constants (n = 18 and 60),
+    ## carrying the sensitivities of a fit: screening 3e-3, default 1e-3, publication 1e-6 (FRET errors are these times the FRET
+    ## baseline dF). Plain simulations at n = 60 are up to 5x less accurate (screening 1.5e-2, default 2.5e-3, publication 4e-6).
+    ## Screening only saves 1.2-1.5x over default: at BDF orders up to 5 the number of steps only falls as rtol^(1/6) (59 vs 96
+    ## steps at n = 18, with one Jacobian per solve), and looser tolerances leave its error bound. Reference is only meant for
+    ## checking the others.
+    tolerance_presets = {'screening':(1e-2, 1e-4), 'default':(1e-3, 1e-5), 'publication':(1e-6, 1e-8), 'reference':(1e-10, 1e-12)}
+    tolerance_errors = {'screening':3e-3, 'default':1e-3, 'publication':1e-6} # Annealed fraction error bounds above, used by auto_tune_solver
+    integrators = ['BDF', 'Radau', 'LSODA', 'RK45'] # solve_ivp methods, the implicit ones get the analytic Jacobian
+
+    def __init__(self, fret_experiment, engine='Kernel', batched=False, pseudo_first_order=False, pseudo_first_order_ratio=10, cache_size=0, workers=1, 
+    conservation_reduction=False, tolerance='default', integrator='BDF'):
         self.time = fret_experiment.time
         self.rna = fret_experiment.rna
         self.enzyme = fret_experiment.enzyme
         self.n = fret_experiment.n
         self.species_list()
+        if engine not in ['Kernel', 'Matrix']: # Kernel is the fast rate law, Matrix is the original relaxation matrix path kept for cross-checking
+            raise ValueError(f"Unknown kinetic engine {engine}, choose from Kernel or Matrix")
+        self.engine = engine
+        self.pseudo_first_order = pseudo_first_order # True forces the closed form solution for every enzyme condition, Auto only where enzyme is in excess
+        self.pseudo_first_order_ratio = pseudo_first_order_ratio # Minimum [E]/[RNA] for the Auto setting
+        self.pseudo_first_order_conditions = [self.pseudo_first_order_regime(e, r) for r in self.rna for e in self.enzyme]
+        self.batched = batched and engine == 'Kernel' # Integrate all enzyme and RNA conditions as one block diagonal system
+        self.conservation_reduction = conservation_reduction # Integrate the kernel on the species left after eliminating the conservation laws
+        if tolerance not in self.tolerance_presets:
+            raise ValueError(f"Unknown tolerance preset {tolerance}, choose from {', '.join(self.tolerance_presets)}")
+        self.tolerance = tolerance
+        if integrator not in self.integrators:
+            raise ValueError(f"Unknown integrator {integrator}, choose from {', '.join(self.integrators)}")
+        self.integrator = integrator
+        self.deadline = None # perf_counter() after which integrations stop with a RuntimeError, set by auto_tune_solver to give up on slow integrators
+        self.kernels = {} # DistributiveKernel for each (number of blocks, sensitivity parameters) combination that has been solved
+        self.carried_sensitivities = () # Sensitivities solved in every objective evaluation once an analytic Jacobian is used, see objective_jacobian
+        self.simulated_rate_constants = [] # Rate constants of the last simulation
+        self.sensitivity_params = []
+        self.cache = KineticsCache(cache_size) # Solved concentrations for recently simulated rate constants, in MB
+        self.workers = workers # Worker processes that share the kernel conditions of one simulation, 1 solves everything in this process
+        self.pool = None # Persistent worker pool, started on the first parallel simulation
+        self.dense_output = False # Keep a continuous solution of every condition from the next simulation, see interpolate_kinetics
+        self.dense_solutions = {} # Callable returning the (species, time) concentrations at any time points, for each condition
+        self.conditions_key = (tuple(self.enzyme), tuple(self.rna), tuple([tuple(time_vector) for time_vector in self.time]), engine, self.batched, tuple(self.pseudo_first_order_conditions), tolerance, integrator)
+
+    def __getstate__(self):
+        # Pickled copies (pool workers, error analysis processes) don't get the worker pool and simulate in their own process
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['workers'] = 1
+        state['dense_solutions'] = {}
+        state.pop('kernel_interpolant', None)
+        return state
+
+    def close_worker_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def get_kernel(self, blocks, sensitivities=()):
+        if (blocks, sensitivities) not in self.kernels:
+            if self.conservation_reduction: # Sensitivities always come from the full kernel
+                self.kernels[(blocks, sensitivities)] = ConservedKernel(DistributiveKernel(self.n, blocks, sensitivities), *self.conservation_laws(self.n))
+            else:
+                self.kernels[(blocks, sensitivities)] = DistributiveKernel(self.n, blocks, sensitivities)
+        return self.kernels[(blocks, sensitivities)]
+
+    def pseudo_first_order_regime(self, enzyme, rna):
+        if enzyme == 0:
+            return False
+        elif self.pseudo_first_order == 'Auto':
+            return enzyme/rna >= self.pseudo_first_order_ratio
+        else:
+            return self.pseudo_first_order == True
 
     def species_list(self):
         species = ['E*','E'] # Binding incompetent and competent enzyme
@@ -20,11 +95,16 @@ class DistributiveDeadenylation():
             species.append(f"TA{x}") # Free RNA
         species.append('A1') # Free AMP arising from deadenylation
         self.species = species
+        self.species_index = {specie:index for index, specie in enumerate(species)}
 
     def setup_concentrations(self):
-        self.concentrations = {}
-        for specie in self.species:
-            self.concentrations[specie] = []
+        ## All concentrations are held in one (condition, species, time) array, where condition = RNA index*len(enzyme) + enzyme index
+        ## and species are ordered as in self.species. Conditions have different numbers of time points, so the time axis is
+        ## zero padded to the longest condition, use get_concentrations for unpadded views.
+        self.concentrations = np.zeros((len(self.rna)*len(self.enzyme), len(self.species), max([len(time_vector) for time_vector in self.time])))
+
+    def get_concentrations(self, specie, condition):
+        return self.concentrations[condition, self.species_index[specie], :len(self.time[condition % len(self.enzyme)])]
 
     def initial_concentration_guesses(self, enzyme, rna, k1, km1, n):
         ## Make list of t=0 concentrations of enzyme and substrate.
@@ -43,6 +123,59 @@ class DistributiveDeadenylation():
         C0.append(0) # A1, initially zero
         self.C0 = C0
 
+    def initial_sensitivity_guesses(self, enzyme, k1, km1, sensitivities):
+        ## Derivatives of the t=0 concentrations with respect to each parameter in sensitivities, only the equilibrium
+        ## E* <-> E split depends on the rate constants
+        S0 = np.zeros((len(sensitivities), 2*self.n + 3))
+        K = k1/km1
+        for j, k in enumerate(sensitivities):
+            if k == 'k1':
+                dE = enzyme/(km1*(1 + K)**2) # d[E]/dk1
+            elif k == 'km1':
+                dE = -enzyme*K/(km1*(1 + K)**2) # d[E]/dk-1
+            else:
+                continue
+            S0[j, 0] = -dE # E*
+            S0[j, 1] = dE # E
+        return S0
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def conservation_laws(n):
+        ## Conservation laws w*C = constant of the scheme in relaxation_matrix, derived from its stoichiometry. w*d/dt C = w*R*C
+        ## vanishes for every C only if w*R = 0 for all rate constants and [E], so the laws span the common left null space of
+        ## relaxation matrices at a few random values (total enzyme, total RNA and total nucleotides). Each law gets a dependent
+        ## species, picked greedily among the species with the fewest Jacobian entries so that eliminating it adds little fill-in
+        ## to the Jacobian, and the laws are combined so that each has a unit coefficient for its own dependent species and none
+        ## for the others. Returns the (law, species) coefficients and the dependent and independent species indices.
+        rng = np.random.default_rng(0)
+        R = np.vstack([np.array(DistributiveDeadenylation.relaxation_matrix([0, rng.uniform(0.5, 2)], *rng.uniform(0.5, 2, 5), n)).T for sample in range(3)])
+        vt = np.linalg.svd(R)[2]
+        singular_values = np.linalg.svd(R, compute_uv=False)
+        laws = vt[singular_values <= 1e-10*singular_values[0]]
+        rows, cols = DistributiveDeadenylation.jacobian_sparsity(n)
+        dependent = []
+        for species in np.argsort(np.bincount(cols, minlength=2*n + 3), kind='stable'):
+            if np.linalg.matrix_rank(laws[:, dependent + [species]]) > len(dependent):
+                dependent.append(species)
+            if len(dependent) == len(laws):
+                break
+        laws = np.round(np.linalg.solve(laws[:, dependent], laws), 10)
+        return laws, np.array(dependent), np.array([s for s in range(2*n + 3) if s not in dependent])
+
+    def conservation_drift(self):
+        ## Largest change over time of each conserved total (see conservation_laws) as a fraction of the RNA concentration,
+        ## (condition, law) array for the last simulation. Zero up to round-off when the laws are eliminated from the integration.
+        laws, dependent, independent = self.conservation_laws(self.n)
+        drift = np.zeros((len(self.rna)*len(self.enzyme), len(laws)))
+        for r, rna in enumerate(self.rna):
+            for i, enzyme in enumerate(self.enzyme):
+                condition = r*len(self.enzyme) + i
+                self.initial_concentration_guesses(enzyme, rna, self.simulated_rate_constants[0], self.simulated_rate_constants[1], self.n)
+                totals = np.matmul(laws, self.concentrations[condition, :, :len(self.time[i])])
+                drift[condition] = np.max(np.abs(totals - np.matmul(laws, self.C0)[:, None]), axis=1)/rna
+        return drift
+
     @staticmethod
     def relaxation_matrix(C0, k1, km1, k2, km2, kcat, n):
         ## Relaxation matrix for nuclease activity, assumes just up to 3mer polyA strand length here as an example (n=3).
@@ -79,64 +212,526 @@ class DistributiveDeadenylation():
 
         return R
 
-    def extract_solved_concentrations(self, solver_result, time):
-        tmp = [[] for x in solver_result.y]
-        for i, v in enumerate(time):
-            idx = np.where(solver_result.t == v)[0][0] # Find index of time point in model that matches time point in experiment
-            for j,k in enumerate(solver_result.y):
-                tmp[j].append(k[idx])
-        self.concentrations['E*'].append(tmp[0])
-        self.concentrations['E'].append(tmp[1])
-        for x in range(1,self.n+1): # Don't have to use two for loops because concentrations is dict not list
-            self.concentrations[f"ETA{x}"].append(tmp[x+1]) # x+1 to move past E* and E, ETAi are before TAi
-            self.concentrations[f"TA{x}"].append(tmp[x+self.n+1]) # x+n+1 because ETAi and TAi are separated by n indices
-        self.concentrations['A1'].append(tmp[-1]) # A1 is last
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def jacobian_sparsity(n):
+        ## Fixed sparsity pattern of the Jacobian dR(C)C/dC, returned as (rows, columns) index arrays.
+        ## Species indices are E* = 0, E = 1, ETAi = i + 1, TAi = i + n + 1 and A1 = 2*n + 2.
+        ## The k-2, kcat, k1 and k-1 terms are linear and give a few bands, while the bilinear k2*[E]*[TAi]
+        ## terms only add the E row and column plus the ETAi/TAi diagonals of the free RNA columns.
+        ## Every entry is listed once and in the same order as the values built in jacobian.
+        eta = np.arange(1, n + 1) + 1
+        ta = np.arange(1, n + 1) + n + 1
+        rows = np.concatenate(([0, 0, 1, 1], [1]*n, [1]*n, eta, eta, eta, ta, ta[:-1], ta, ta, [2*n + 2]*(n - 1)))
+        cols = np.concatenate(([0, 1, 0, 1], eta, ta, [1]*n, eta, ta, eta, eta[1:], [1]*n, ta, eta[1:]))
+        return rows, cols
+
+    @staticmethod
+    def jacobian(C, k1, km1, k2, km2, kcat, n):
+        ## Exact Jacobian of d/dt C = R(C)*C. R only depends on C through [E] in the k2*[E]*[TAi] binding terms,
+        ## so the Jacobian is the relaxation matrix plus the derivatives of those bilinear terms with respect to [E]:
+        ##   d(d[E]/dt)/d[E] = -k-1 - k2*sum([TAi]),  d(d[E]/dt)/d[TAi] = -k2*[E]
+        ##   d(d[ETAi]/dt)/d[E] = k2*[TAi],           d(d[ETAi]/dt)/d[TAi] = k2*[E]
+        ##   d(d[TAi]/dt)/d[E] = -k2*[TAi],           d(d[TAi]/dt)/d[TAi] = -k2*[E]
+        ## Returned as a sparse matrix with the pattern from jacobian_sparsity so BDF factorizes it with a sparse LU.
+        TA = np.asarray(C[n + 2:2*n + 2])
+        E = C[1]
+        data = np.concatenate(([-k1, km1, k1, -km1 - k2*np.sum(TA)], [km2], [km2 + kcat]*(n - 1), -k2*E*np.ones(n), # E*, E rows
+                            k2*TA, [-km2], [-km2 - kcat]*(n - 1), k2*E*np.ones(n), # ETAi rows
+                            [km2]*n, [kcat]*(n - 1), -k2*TA, -k2*E*np.ones(n), # TAi rows
+                            [kcat]*(n - 1))) # A1 row
+        rows, cols = DistributiveDeadenylation.jacobian_sparsity(n)
+        return csc_matrix((data, (rows, cols)), shape=(2*n + 3, 2*n + 3))
 
+    def extract_solved_concentrations(self, solver_time, solver_concentrations, time, condition, solver_sensitivities=None):
+        time_indices = np.searchsorted(solver_time, time) # Solver time points are sorted and unique, map each experimental (replicate) time point onto them
+        self.concentrations[condition, :, :len(time)] = solver_concentrations[:, time_indices]
+        if solver_sensitivities is not None:
+            self.sensitivities[condition, :, :, :len(time)] = solver_sensitivities[:, :, time_indices]
 
     def calculate_total_rna_concentrations(self):
-        self.total_rna_concentrations = {k:[] for k in self.concentrations.keys() if 'E' not in k}
-        for i, v in enumerate(self.enzyme):
-            for j in range(1, self.n+1):
-                self.total_rna_concentrations[f'TA{j}'].append([sum(x) for x in zip(self.concentrations[f'TA{j}'][i], self.concentrations[f'ETA{j}'][i])]) # TAi,T = [TAi] + [ETAi]
-            self.total_rna_concentrations['A1'].append(self.concentrations['A1'][i]) # TAi,T = [TAi] + [ETAi]
+        ## (condition, species, time) array of total RNA, TAi,T = [TAi] + [ETAi], with A1 as the last species
+        self.total_rna_species = [f'TA{x}' for x in range(1, self.n+1)] + ['A1']
+        self.total_rna_index = {specie:index for index, specie in enumerate(self.total_rna_species)}
+        self.total_rna_concentrations = np.concatenate((self.concentrations[:, self.n+2:2*self.n+2] + self.concentrations[:, 2:self.n+2], self.concentrations[:, -1:]), axis=1)
+
+    def get_total_rna_concentrations(self, specie, condition):
+        return self.total_rna_concentrations[condition, self.total_rna_index[specie], :len(self.time[condition % len(self.enzyme)])]
 
+    def calculate_total_rna_sensitivities(self):
+        ## (condition, parameter, TAi,T, time) array of dTAi,T/dp, same species order as total_rna_concentrations without A1
+        self.total_rna_sensitivities = self.sensitivities[:, :, self.n+2:2*self.n+2] + self.sensitivities[:, :, 2:self.n+2]
 
-    def simulate_kinetics(self, params):
+    def simulate_kinetics(self, params, sensitivities=()):
         ## Run numerical integration of rate equations for a given kinetic model from t=0, returns Ci(t)
         ## Needs initial guesses for concentrations of each species at t=0
+        ## Optionally also returns the forward sensitivities dCi(t)/dp for the rate constants in sensitivities, stored in a
+        ## (condition, parameter, species, time) array in the same layout as the concentrations.
         k1 = params['k1'].value
         km1 = params['km1'].value
         k2 = params['k2'].value
         km2 = params['km2'].value
         kcat = params['kcat'].value
+        sensitivities = tuple(sensitivities)
+        self.simulated_rate_constants = [k1, km1, k2, km2, kcat]
+        self.sensitivity_params = list(sensitivities)
+
+        cache_key = (k1, km1, k2, km2, kcat, sensitivities, self.conditions_key)
+        cached = None if self.dense_output else self.cache.get(cache_key) # Dense solutions only come from an integration
+        if cached is not None: # Only the hybridization parameters changed since these rate constants were solved
+            self.concentrations, self.sensitivities = cached
+            return
 
         self.setup_concentrations()
+        self.dense_solutions = {}
+        if len(sensitivities) > 0:
+            self.sensitivities = np.zeros((self.concentrations.shape[0], len(sensitivities)) + self.concentrations.shape[1:])
+        kernel_conditions = [(self.enzyme[i], rna, self.time[i]) for r, rna in enumerate(self.rna) for i, v in enumerate(self.enzyme) if (v != 0) & (not self.pseudo_first_order_conditions[r*len(self.enzyme) + i])]
+        kernel_solutions = None # (time, concentrations, sensitivities) of each kernel condition when these are solved up front
+        if (self.workers > 1) & (self.engine != 'Matrix') & (len(kernel_conditions) > 1) & (not self.dense_output): # Solver interpolants stay in this process
+            kernel_solutions = self.solve_parallel_kinetics(kernel_conditions, [k1, km1, k2, km2, kcat], sensitivities)
+        elif self.batched & (len(kernel_conditions) > 0):
+            kernel_solutions = self.split_kernel_solution(*self.solve_kernel_kinetics(kernel_conditions, k1, km1, k2, km2, kcat, sensitivities))
+        block = 0
         for r, rna in enumerate(self.rna):
             for i, v in enumerate(self.enzyme):
-                if self.enzyme[i] == 0: # No enzyme means nothing happens, all RNA is full length at all times
-                    self.concentrations[f'E*'].append([0 for x in range(len(self.time[i]))])
-                    self.concentrations[f'E'].append([0 for x in range(len(self.time[i]))])
-                    self.concentrations[f'A1'].append([0 for x in range(len(self.time[i]))])
-                    for l in range(1, self.n+1):
-                        if l == self.n:
-                            self.concentrations[f'TA{self.n}'].append([rna for x in range(len(self.time[i]))])
-                            self.concentrations[f'ETA{self.n}'].append([0 for x in range(len(self.time[i]))])
-                        else:
-                            self.concentrations[f'TA{l}'].append([0 for x in range(len(self.time[i]))])
-                            self.concentrations[f'ETA{l}'].append([0 for x in range(len(self.time[i]))])
+                condition = r*len(self.enzyme) + i
+                if self.pseudo_first_order_conditions[condition]:
+                    solved_time, solved_concentrations, solved_sensitivities = self.solve_pseudo_first_order_kinetics(self.enzyme[i], rna, self.time[i], k1, km1, k2, km2, kcat, sensitivities)
+                    self.extract_solved_concentrations(solved_time, solved_concentrations, self.time[i], condition, solved_sensitivities)
+                    if self.dense_output: # The closed form is itself continuous in time
+                        self.dense_solutions[condition] = self.pseudo_first_order_dense_solution(self.enzyme[i], rna, k1, km1, k2, km2, kcat)
+                elif self.enzyme[i] == 0: # No enzyme means nothing happens, all RNA is full length at all times
+                    self.concentrations[condition, self.species_index[f'TA{self.n}'], :len(self.time[i])] = rna
+                    if self.dense_output:
+                        self.dense_solutions[condition] = self.constant_dense_solution(self.concentrations[condition, :, 0])
+                elif kernel_solutions is not None:
+                    solved_time, solved_concentrations, solved_sensitivities = kernel_solutions[block]
+                    self.extract_solved_concentrations(solved_time, solved_concentrations, self.time[i], condition, solved_sensitivities)
+                    if self.dense_output:
+                        self.dense_solutions[condition] = self.kernel_dense_solution(self.kernel_interpolant, block)
+                    block += 1
+                elif (self.engine != 'Matrix') | (len(sensitivities) > 0): # Sensitivities are always solved with the kernel
+                    solved_time, solved_concentrations, solved_sensitivities = self.solve_kernel_kinetics([(self.enzyme[i], rna, self.time[i])], k1, km1, k2, km2, kcat, sensitivities)
+                    self.extract_solved_concentrations(solved_time, solved_concentrations[0], self.time[i], condition, None if solved_sensitivities is None else solved_sensitivities[0])
+                    if self.dense_output:
+                        self.dense_solutions[condition] = self.kernel_dense_solution(self.kernel_interpolant, 0)
                 else:
                     self.initial_concentration_guesses(self.enzyme[i], rna, k1, km1, self.n)
-                    param_args = {'k1':k1, 'km1':km1, 'k2':k2, 'km2':km2, 'kcat':kcat, 'n':self.n}
-                    time_span = (np.min(self.time[i]),np.max(self.time[i]))
+                    time_span = (np.min(self.time[i]),self.dense_end_time() if self.dense_output else np.max(self.time[i]))
                     initial_concs = self.C0
-                    rate_func = self.relaxation_matrix
                     t_return = np.unique(np.array(self.time[i]))  # only solve for unique time points
-                    solver_result = solve_ivp(propagator,time_span,initial_concs,t_eval=t_return,method='BDF',first_step=1e-12,atol=1e-12,args=(rate_func, param_args))
-                    self.extract_solved_concentrations(solver_result,self.time[i])
+                    param_args = {'k1':k1, 'km1':km1, 'k2':k2, 'km2':km2, 'kcat':kcat, 'n':self.n}
+                    rate_func = self.relaxation_matrix
+                    jac_func = self.jacobian
+                    solved_time, solved_concentrations, dense_solution = self.solve_scaled(lambda t, C: propagator(t, C, rate_func, param_args),
+                    lambda t, C: jacobian_propagator(t, C, jac_func, param_args), time_span, np.array(initial_concs), t_return,
+                    np.full(len(initial_concs), rna), self.characteristic_time([self.enzyme[i]], k2, km2, kcat, time_span))
+                    self.extract_solved_concentrations(solved_time, solved_concentrations, self.time[i], condition)
+                    if self.dense_output:
+                        self.dense_solutions[condition] = dense_solution
+        if not self.dense_output:
+            self.cache.put(cache_key, (self.concentrations, self.sensitivities if len(sensitivities) > 0 else None))
+
+    def dense_end_time(self):
+        # Dense solutions of every condition cover the longest time vector, so they can all be sampled on one common grid
+        return max([np.max(time_vector) for time_vector in self.time])
+
+    @staticmethod
+    def kernel_dense_solution(kernel_interpolant, block):
+        # Concentrations of one condition of a solve_kernel_kinetics interpolant
+        def dense_solution(time):
+            return kernel_interpolant(time)[block]
+        return dense_solution
+
+    def pseudo_first_order_dense_solution(self, enzyme, rna, k1, km1, k2, km2, kcat):
+        def dense_solution(time):
+            solved_time, solved_concentrations, solved_sensitivities = self.solve_pseudo_first_order_kinetics(enzyme, rna, time, k1, km1, k2, km2, kcat)
+            return solved_concentrations[:, np.searchsorted(solved_time, time)]
+        return dense_solution
+
+    @staticmethod
+    def constant_dense_solution(concentrations):
+        def dense_solution(time):
+            return np.repeat(np.asarray(concentrations)[:, None], len(time), axis=1)
+        return dense_solution
+
+    def interpolate_kinetics(self, dense_model):
+        ## Fill the concentrations at this model's time points from the dense solutions of dense_model, which was simulated
+        ## for the same enzyme and RNA conditions with dense_output set, instead of integrating the rate equations again.
+        ## Time points must lie within the time vectors of dense_model.
+        self.setup_concentrations()
+        for condition, dense_solution in dense_model.dense_solutions.items():
+            time = np.asarray(self.time[condition % len(self.enzyme)])
+            self.concentrations[condition, :, :len(time)] = dense_solution(time)
+        self.simulated_rate_constants = list(dense_model.simulated_rate_constants)
+        self.sensitivity_params = []
+
+    @staticmethod
+    def split_kernel_solution(solver_time, concentrations, sensitivities):
+        # One (time, concentrations, sensitivities) tuple per condition of a solve_kernel_kinetics result
+        return [(solver_time, concentrations[b], None if sensitivities is None else sensitivities[b]) for b in range(len(concentrations))]
+
+    def solve_parallel_kinetics(self, conditions, rate_constants, sensitivities=()):
+        ## Split the kernel conditions into one contiguous chunk per worker and solve the chunks in the persistent worker pool.
+        ## Each worker keeps its own copy of this model (and its kernels) from the pool initializer, so only the conditions and
+        ## rate constants are sent per call. Chunks are gathered in submission order, so the result does not depend on timing.
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=set_worker_kinetic_model, initargs=(self,))
+        chunks = [chunk for chunk in np.array_split(np.arange(len(conditions)), min(self.workers, len(conditions)))]
+        futures = [self.pool.submit(solve_worker_kinetics, [conditions[c] for c in chunk], rate_constants, sensitivities) for chunk in chunks]
+        return [solution for future in futures for solution in future.result()]
+
+    def solve_kernel_kinetics(self, conditions, k1, km1, k2, km2, kcat, sensitivities=()):
+        ## Integrate a list of (enzyme, RNA, time) conditions with the rate law kernel. Several conditions are stacked into one
+        ## block diagonal system and integrated once over the union of their time points, so solver setup, step size ramp-up
+        ## and Jacobian factorizations are shared between conditions. Returns the union time points, a
+        ## (condition, species, time) array of concentrations and, if sensitivities are requested, a
+        ## (condition, parameter, species, time) array of dC/dp (None otherwise).
+        kernel = self.get_kernel(len(conditions), sensitivities)
+        kernel.set_rate_constants(k1, km1, k2, km2, kcat)
+        initial_concs = []
+        for enzyme, rna, time in conditions:
+            self.initial_concentration_guesses(enzyme, rna, k1, km1, self.n)
+            initial_concs.append(self.C0)
+            initial_concs.extend(self.initial_sensitivity_guesses(enzyme, k1, km1, sensitivities)*kernel.sensitivity_scales[:, None]) # Kernel integrates scaled sensitivities
+        all_time = np.unique(np.concatenate([time for enzyme, rna, time in conditions]))
+        time_span = (np.min(all_time), self.dense_end_time() if self.dense_output else np.max(all_time))
+        initial_state = np.ravel(initial_concs)
+        if isinstance(kernel, ConservedKernel):
+            initial_state = kernel.set_totals(initial_state)
+        solved_time, solved_state, dense_solution = self.solve_scaled(kernel.rates, kernel.jacobian, time_span, initial_state, all_time,
+        np.repeat([rna for enzyme, rna, time in conditions], len(initial_state)//len(conditions)), self.characteristic_time([enzyme for enzyme, rna, time in conditions], k2, km2, kcat, time_span))
+        full_state = kernel.expand if isinstance(kernel, ConservedKernel) else lambda y: y
+        if self.dense_output: # (condition, species, time) concentrations from the solver interpolant, split per condition in simulate_kinetics
+            self.kernel_interpolant = lambda time: np.reshape(full_state(dense_solution(time)), (len(conditions), kernel.stride, kernel.size, len(time)))[:, 0]
+        solution = np.reshape(full_state(solved_state), (len(conditions), kernel.stride, kernel.size, len(solved_time)))
+        if len(sensitivities) > 0:
+            return solved_time, solution[:, 0], solution[:, 1:]/kernel.sensitivity_scales[None, :, None, None]
+        else:
+            return solved_time, solution[:, 0], None
+
+    @staticmethod
+    def characteristic_time(enzymes, k2, km2, kcat, time_span):
+        # Lifetime of free RNA or of the enzyme-RNA complex, whichever is shorter, at the highest enzyme concentration. Without
+        # any reaction (all rates zero) nothing sets a time scale, and the integration span is used.
+        rate = max(k2*max(enzymes), km2 + kcat)
+        if rate > 0:
+            return 1/rate
+        return time_span[1] - time_span[0] if time_span[1] > time_span[0] else 1
+
+    def solve_scaled(self, rates, jacobian, time_span, initial_state, t_eval, scales, timescale):
+        ## Solve of d/dt C = rates(t, C) with the integrator in scaled variables, y = C/scales with the RNA concentration of each condition as
+        ## its scale and s = t/timescale, so the tolerance preset applies relative to the RNA and the solver picks its first
+        ## step on the scale of the reactions. Each condition is scaled by one number and the Jacobian is block diagonal, so
+        ## the Jacobian in scaled variables is timescale*jacobian. Returns the time points, the unscaled solution and, with
+        ## dense_output, the unscaled interpolant (None otherwise).
+        rtol, atol = self.tolerance_presets[self.tolerance]
+        scaled_rates = lambda s, y: timescale*rates(s*timescale, y*scales)/scales
+        if self.deadline is not None:
+            scaled_rates = time_limited(scaled_rates, self.deadline)
+        jacobian_kws = {}
+        if self.integrator in ['BDF', 'Radau']:
+            jacobian_kws['jac'] = lambda s, y: timescale*jacobian(s*timescale, y*scales)
+        elif self.integrator == 'LSODA': # LSODA only takes dense Jacobians, and fails on its own first step guess with the fast enzyme binding
+            jacobian_kws['jac'] = lambda s, y: dense_matrix(timescale*jacobian(s*timescale, y*scales))
+            jacobian_kws['first_step'] = 1e-6
+        solver_result = solve_ivp(scaled_rates, (time_span[0]/timescale, time_span[1]/timescale), initial_state/scales, t_eval=t_eval/timescale, method=self.integrator, 
+        rtol=rtol, atol=atol, dense_output=self.dense_output, **jacobian_kws)
+        dense_solution = None
+        if self.dense_output:
+            dense_solution = lambda time: solver_result.sol(np.asarray(time)/timescale)*scales[:, None]
+        return np.asarray(t_eval)[:len(solver_result.t)], solver_result.y*scales[:, None], dense_solution # t_eval itself, t_eval/timescale*timescale can differ by round-off
+
+    def solve_pseudo_first_order_kinetics(self, enzyme, rna, time, k1, km1, k2, km2, kcat, sensitivities=()):
+        ## With enzyme in large excess over RNA the free enzyme concentration hardly changes, so [E] in the k2*[E]*[TAi] terms
+        ## can be held at its t=0 value. The ETAi, TAi and A1 rows/columns of relaxation_matrix then form a linear system with
+        ## constant coefficients, d/dt x = A*x, which is propagated exactly between time points with x(t + dt) = expm(A*dt)*x(t).
+        ## [E*] is held at t=0 and [E] is the t=0 value minus the bound enzyme, so that total enzyme is conserved.
+        ## Sensitivities s_p = dx/dp obey d/dt s_p = A*s_p + dA/dp*x, so each is propagated together with x by the
+        ## exponential of the block lower triangular matrix [[A, 0], [dA/dp, A]].
+        self.initial_concentration_guesses(enzyme, rna, k1, km1, self.n)
+        A = np.array(self.relaxation_matrix(self.C0, k1, km1, k2, km2, kcat, self.n))[2:,2:]
+        m = len(A)
+        dC0 = self.initial_sensitivity_guesses(enzyme, k1, km1, sensitivities)
+        generators = [A]
+        if len(sensitivities) > 0:
+            # A is linear in k2*[E], k-2 and kcat, so its derivatives are relaxation matrices with one unit rate constant
+            A_binding = np.array(self.relaxation_matrix([0, 1], 0, 0, 1, 0, 0, self.n))[2:,2:]
+            dA = {'k2':self.C0[1]*A_binding,
+            'km2':np.array(self.relaxation_matrix([0, 1], 0, 0, 0, 1, 0, self.n))[2:,2:],
+            'kcat':np.array(self.relaxation_matrix([0, 1], 0, 0, 0, 0, 1, self.n))[2:,2:]}
+            for j, k in enumerate(sensitivities):
+                augmented_A = np.zeros((2*m, 2*m))
+                augmented_A[:m, :m] = A
+                augmented_A[m:, m:] = A
+                augmented_A[m:, :m] = dA[k] if k in dA else k2*dC0[j, 1]*A_binding # k1 and k-1 only act through [E]
+                generators.append(augmented_A)
+        t_return = np.unique(np.array(time))
+        solution = np.zeros((1 + len(sensitivities), m, len(t_return)))
+        x = np.zeros((1 + len(sensitivities), m))
+        x[0] = self.C0[2:] # Initial ETAi, TAi and A1 do not depend on the parameters
+        propagators = {} # expm(A*dt), and expm of the augmented generators, for each distinct time step
+        for z, t in enumerate(t_return):
+            dt = t - t_return[z-1] if z > 0 else 0
+            if dt > 0:
+                if dt not in propagators:
+                    propagators[dt] = [expm(generator*dt) for generator in generators]
+                x_new = np.matmul(propagators[dt][0], x[0])
+                for j, propagator in enumerate(propagators[dt][1:]):
+                    x[j + 1] = np.matmul(propagator[m:], np.concatenate((x[0], x[j + 1])))
+                x[0] = x_new
+            solution[:, :, z] = x
+        solved_concentrations = np.zeros((1 + len(sensitivities), len(self.C0), len(t_return)))
+        solved_concentrations[:, 2:] = solution
+        solved_concentrations[0, 0] = self.C0[0]
+        solved_concentrations[0, 1] = self.C0[1]
+        solved_concentrations[1:, :2] = dC0[:, :2, None]
+        solved_concentrations[:, 1] -= np.sum(solution[:, :self.n], axis=1)
+        if len(sensitivities) > 0:
+            return t_return, solved_concentrations[0], solved_concentrations[1:]
+        else:
+            return t_return, solved_concentrations[0], None
+
+
+class DistributiveKernel():
+    ## Precompiled rate law for the distributive scheme of a given tail length n. Computes the same fluxes as
+    ## propagator(relaxation_matrix) but works on slices of C with preallocated buffers, so each call is O(n)
+    ## instead of building and multiplying a (2n+3)x(2n+3) nested list. The analytic Jacobian is assembled into
+    ## a fixed CSC structure, only the k2*[E]*[TAi] entries change between calls.
+    ## With blocks > 1, C holds that many independent reaction conditions back to back (e.g. one per enzyme
+    ## concentration) that share the rate constants, giving a block diagonal system that is integrated in one solve.
+    ## With sensitivities, each block is followed by the scaled forward sensitivities p*dC/dp for those rate constants.
+    def __init__(self, n, blocks=1, sensitivities=()):
+        self.n = n
+        self.blocks = blocks
+        self.sensitivities = tuple(sensitivities)
+        self.stride = 1 + len(self.sensitivities) # Concentrations plus one sensitivity vector per parameter in each block
+        self.size = 2*n + 3 # Species per block
+        self.binding = np.zeros((blocks, n)) # k2*[E]*[TAi]
+        self.release = np.zeros((blocks, n)) # k-2*[ETAi]
+        self.catalysis = np.zeros((blocks, n - 1)) # kcat*[ETAi], i = 2 to n
+        self.jacobian_structure()
+
+    def jacobian_structure(self):
+        ## Map the entries of DistributiveDeadenylation.jacobian_sparsity onto CSC order once, so the Jacobian values
+        ## can be written in pattern order and permuted instead of converting COO -> CSC on every call.
+        ## The block diagonal CSC structure is the single block structure repeated with shifted row and data offsets.
+        n = self.n
+        total_blocks = self.blocks*self.stride
+        rows, cols = DistributiveDeadenylation.jacobian_sparsity(n)
+        template = csc_matrix((np.arange(1, len(rows) + 1), (rows, cols)), shape=(self.size, self.size))
+        template.sort_indices()
+        self.csc_order = template.data.astype(int) - 1
+        self.csc_indices = np.concatenate([template.indices[:0]] + [template.indices + b*self.size for b in range(total_blocks)])
+        self.csc_indptr = np.concatenate([template.indptr[:-1] + b*len(rows) for b in range(total_blocks)] + [[total_blocks*len(rows)]])
+        self.jacobian_data = np.zeros((self.blocks, len(rows)))
+        # Offsets of the state dependent entries in jacobian_sparsity order
+        self.jac_E_E = 3
+        self.jac_E_TA = slice(4 + n, 4 + 2*n)
+        self.jac_ETA_E = slice(4 + 2*n, 4 + 3*n)
+        self.jac_ETA_TA = slice(4 + 4*n, 4 + 5*n)
+        self.jac_TA_E = slice(4 + 7*n - 1, 4 + 8*n - 1)
+        self.jac_TA_TA = slice(4 + 8*n - 1, 4 + 9*n - 1)
+
+    def set_rate_constants(self, k1, km1, k2, km2, kcat):
+        self.k1 = k1
+        self.km1 = km1
+        self.k2 = k2
+        self.km2 = km2
+        self.kcat = kcat
+        n = self.n
+        # Sensitivities are integrated as p*dC/dp so they have the same scale as the concentrations and the same tolerances apply
+        self.sensitivity_scales = np.array([getattr(self, k) if getattr(self, k) != 0 else 1 for k in self.sensitivities])
+        self.unit_scales = np.array([[self.sensitivity_scales[j] if k == p else 0 for j, p in enumerate(self.sensitivities)] for k in DistributiveDeadenylation.rate_constants])
+        # Constant entries of the Jacobian only need to be written when the rate constants change
+        self.jacobian_data[:, :3] = [-k1, km1, k1]
+        self.jacobian_data[:, 4:4 + n] = [km2] + [km2 + kcat]*(n - 1) # E row, ETAi columns
+        self.jacobian_data[:, 4 + 3*n:4 + 4*n] = [-km2] + [-km2 - kcat]*(n - 1) # ETAi diagonal
+        self.jacobian_data[:, 4 + 5*n:4 + 6*n] = km2 # TAi row, ETAi columns
+        self.jacobian_data[:, 4 + 6*n:4 + 7*n - 1] = kcat # TAi row, ETAi+1 columns
+        self.jacobian_data[:, 4 + 9*n - 1:] = kcat # A1 row
+
+    @staticmethod
+    def flux_rates(dC, activation, binding, release, catalysis):
+        ## Assemble d/dt C from the reaction fluxes activation = k1*[E*] - k-1*[E], binding = k2*[E]*[TAi], release = k-2*[ETAi]
+        ## and catalysis = kcat*[ETAi] for i = 2 to n. Works on any leading (block, ...) dimensions, dC can be a view.
+        n = binding.shape[-1]
+        cleaved = catalysis.sum(axis=-1)
+        dC[..., 0] = -activation # E*
+        dC[..., 1] = activation + release.sum(axis=-1) + cleaved - binding.sum(axis=-1) # E
+        dETA = dC[..., 2:n + 2] # ETAi
+        np.subtract(binding, release, out=dETA)
+        dETA[..., 1:] -= catalysis
+        dTA = dC[..., n + 2:2*n + 2] # TAi
+        np.subtract(release, binding, out=dTA)
+        dTA[..., :-1] += catalysis
+        dC[..., -1] = cleaved # A1
+
+    def rates(self, t, C, out=None):
+        ## d/dt C for the distributive scheme, written into out if given
+        n = self.n
+        if out is None:
+            out = np.empty(self.blocks*self.stride*self.size)
+        Y = C.reshape(self.blocks, self.stride, self.size) # Views, one row per block and sensitivity
+        dY = out.reshape(self.blocks, self.stride, self.size)
+        E = Y[:, 0, 1]
+        ETA = Y[:, 0, 2:n + 2]
+        activation = self.k1*Y[:, 0, 0] - self.km1*E
+        np.multiply(Y[:, 0, n + 2:2*n + 2], self.k2*E[:, None], out=self.binding)
+        np.multiply(ETA, self.km2, out=self.release)
+        np.multiply(ETA[:, 1:], self.kcat, out=self.catalysis)
+        self.flux_rates(dY[:, 0], activation, self.binding, self.release, self.catalysis)
+        if self.stride > 1:
+            self.sensitivity_rates(Y, dY, activation)
+        return out
+
+    def sensitivity_rates(self, Y, dY, activation):
+        ## Forward sensitivity equations d/dt S_p = J*S_p + p*df/dp for the scaled sensitivities S_p = p*dC/dp, all parameters at once.
+        ## Each flux is linear in one rate constant, so J*S_p is the fluxes linearized around C and applied to S_p, and p*df/dp
+        ## adds the flux of parameter p itself.
+        n = self.n
+        C = Y[:, 0]
+        S = Y[:, 1:] # (block, parameter, species)
+        E = C[:, 1, None, None]
+        TA = C[:, None, n + 2:2*n + 2]
+        ETA = C[:, None, 2:n + 2]
+        u = self.unit_scales # (rate constant, parameter), p for the sensitivity of p and zero otherwise
+        S_activation = self.k1*S[..., 0] - self.km1*S[..., 1] + u[0]*C[:, 0, None] - u[1]*C[:, 1, None]
+        S_binding = self.k2*(E*S[..., n + 2:2*n + 2] + S[..., 1, None]*TA) + u[2, :, None]*E*TA
+        S_release = self.km2*S[..., 2:n + 2] + u[3, :, None]*ETA
+        S_catalysis = self.kcat*S[..., 3:n + 2] + u[4, :, None]*ETA[..., 1:]
+        self.flux_rates(dY[:, 1:], S_activation, S_binding, S_release, S_catalysis)
+
+    def jacobian(self, t, C):
+        ## Analytic Jacobian as in DistributiveDeadenylation.jacobian, returned as a new CSC matrix sharing the fixed structure.
+        ## For the sensitivity equations each S_p block gets the same Jacobian as its concentrations and the coupling back to C is
+        ## dropped, the block diagonal approximation used by simultaneous corrector sensitivity solvers.
+        n = self.n
+        C = C.reshape(self.blocks, self.stride, self.size)[:, 0]
+        E = C[:, 1:2]
+        TA = C[:, n + 2:2*n + 2]
+        data = self.jacobian_data
+        data[:, self.jac_E_E] = -self.km1 - self.k2*TA.sum(axis=1)
+        data[:, self.jac_E_TA] = -self.k2*E
+        np.multiply(TA, self.k2, out=data[:, self.jac_ETA_E])
+        data[:, self.jac_ETA_TA] = self.k2*E
+        np.multiply(TA, -self.k2, out=data[:, self.jac_TA_E])
+        data[:, self.jac_TA_TA] = -self.k2*E
+        if self.stride > 1:
+            data = np.repeat(data, self.stride, axis=0)
+        size = self.blocks*self.stride*self.size
+        return csc_matrix((data[:, self.csc_order].ravel(), self.csc_indices, self.csc_indptr), shape=(size, size))
+
+
+class ConservedKernel():
+    ## Integrates a DistributiveKernel on its independent species only. Every block, and every sensitivity vector, of the kernel
+    ## obeys the conservation laws of DistributiveDeadenylation.conservation_laws, so the dependent species are the totals of the
+    ## initial state minus the laws applied to the independent species. The reduced Jacobian is the kernel Jacobian restricted
+    ## to the independent species plus the dependent species columns carried through the laws.
+    def __init__(self, kernel, laws, dependent, independent):
+        self.kernel = kernel
+        self.full_laws = laws
+        self.laws = laws[:, independent]
+        self.dependent = dependent
+        self.independent = independent
+        self.vectors = kernel.blocks*kernel.stride # Concentration and sensitivity vectors, each with its own totals
+        self.full_state = np.zeros((self.vectors, kernel.size))
+        self.full_rates = np.zeros(self.vectors*kernel.size)
+        offsets = kernel.size*np.arange(self.vectors)[:, None]
+        reduced = np.arange(self.vectors*len(independent)).reshape(self.vectors, -1)
+        self.selection = csc_matrix((np.ones(reduced.size), (reduced.ravel(), (offsets + independent).ravel())), shape=(reduced.size, self.full_rates.size))
+        rows = np.concatenate(((offsets + independent).ravel(), np.repeat(offsets + dependent, len(independent), axis=1).ravel()))
+        cols = np.concatenate((reduced.ravel(), np.tile(reduced, len(dependent)).ravel()))
+        values = np.concatenate((np.ones(reduced.size), np.tile(-self.laws.ravel(), self.vectors)))
+        self.reconstruction = csc_matrix((values, (rows, cols)), shape=(self.full_rates.size, reduced.size))
+        self.reconstruction.eliminate_zeros()
+
+    @property
+    def stride(self):
+        return self.kernel.stride
+
+    @property
+    def size(self):
+        return self.kernel.size
+
+    @property
+    def sensitivity_scales(self):
+        return self.kernel.sensitivity_scales
+
+    def set_rate_constants(self, k1, km1, k2, km2, kcat):
+        self.kernel.set_rate_constants(k1, km1, k2, km2, kcat)
+
+    def set_totals(self, initial_state):
+        # Conserved totals of each vector of a full initial state, returns the reduced initial state
+        initial_state = initial_state.reshape(self.vectors, self.kernel.size)
+        self.totals = np.matmul(initial_state, self.full_laws.T)
+        return initial_state[:, self.independent].ravel()
+
+    def expand(self, y):
+        # Full states from reduced states, y is (reduced species, time) or (reduced species,)
+        Y = np.reshape(y, (self.vectors, len(self.independent), -1))
+        full_state = np.zeros((self.vectors, self.kernel.size, Y.shape[2]))
+        full_state[:, self.independent] = Y
+        full_state[:, self.dependent] = self.totals[:, :, None] - np.matmul(self.laws, Y)
+        return full_state.reshape((self.vectors*self.kernel.size,) + np.shape(y)[1:])
+
+    def rates(self, t, x):
+        X = x.reshape(self.vectors, -1)
+        self.full_state[:, self.independent] = X
+        self.full_state[:, self.dependent] = self.totals - np.matmul(X, self.laws.T)
+        self.kernel.rates(t, self.full_state.ravel(), self.full_rates)
+        return self.full_rates.reshape(self.vectors, -1)[:, self.independent].ravel()
+
+    def jacobian(self, t, x):
+        return (self.selection @ self.kernel.jacobian(t, self.expand(x)) @ self.reconstruction).tocsc()
+
+
+class KineticsCache():
+    ## Least recently used store of solved kinetics, keyed on the rate constants, sensitivities and reaction conditions.
+    ## Bounded by the total size of the stored arrays, the oldest entries are dropped first. Fits that also vary dGo/alpha
+    ## (including finite difference steps on them) reuse the stored concentrations instead of integrating again.
+    def __init__(self, max_megabytes=0):
+        self.max_bytes = max_megabytes*1e6
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def entry_size(arrays):
+        return sum([array.nbytes for array in arrays if array is not None])
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, arrays):
+        size = self.entry_size(arrays)
+        if (size > self.max_bytes) | (key in self.entries):
+            return
+        self.entries[key] = arrays
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            old_key, old_arrays = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_size(old_arrays)
+
+    def __getstate__(self):
+        # Don't send stored entries to worker processes or copies, each starts with an empty cache
+        state = self.__dict__.copy()
+        state['entries'] = OrderedDict()
+        state['nbytes'] = 0
+        return state
 
 
 class DuplexHybridization:
-    def __init__(self, fret_experiment):
+    thermodynamic_params = ['dGo', 'alpha'] # Parameters the duplex equilibria depend on, read from the fit Parameters in simulate_hybridization
+
+    def __init__(self, fret_experiment, engine='Reduced', variable_projection=False):
         self.experimental_fret = fret_experiment.fret # Needed for solving baseline params with Ax = B
         self.dGo = fret_experiment.dGo
         self.alpha = fret_experiment.alpha
@@ -146,9 +741,14 @@ class DuplexHybridization:
         self.QT = fret_experiment.QT
         self.enzyme = fret_experiment.enzyme
         self.rna = fret_experiment.rna
+        if engine not in ['Reduced', 'Root']: # Reduced is the vectorized free quencher solve, Root is the original root solve kept for validation
+            raise ValueError(f"Unknown hybridization engine {engine}, choose from Reduced or Root")
+        self.engine = engine
+        self.variable_projection = variable_projection # Solve the baseline params of all enzyme concentrations at once in closed form, see project_fret_baselines
         self.species_list()
         self.initial_concentration_guesses()
         self.calculate_kq()
+        self.setup_experimental_fret()
 
     def species_list(self):
         species = []
@@ -158,12 +758,30 @@ class DuplexHybridization:
             species.append(f'TA{x}Q') # RNA hybridized to DNA quencher strand
         species.append('Q') # Free quencher strand
         self.species = species
+        self.species_index = {specie:index for index, specie in enumerate(species)}
 
     def setup_concentrations(self):
-        self.concentrations = {}
-        for specie in self.species:
-            self.concentrations[specie] = [[] for concentration in self.enzyme]
-        self.annealed_fraction  =[[] for x in self.enzyme]
+        ## (enzyme, species, time) array as in the kinetic model, zero padded along time. annealed_fraction holds unpadded views
+        ## of the (enzyme, time) annealed_fraction_array for each enzyme concentration.
+        time_points = max([len(time_vector) for time_vector in self.time])
+        self.concentrations = np.zeros((len(self.enzyme), len(self.species), time_points))
+        self.annealed_fraction_array = np.zeros((len(self.enzyme), time_points))
+        self.annealed_fraction = [self.annealed_fraction_array[i, :len(self.time[i])] for i, v in enumerate(self.enzyme)]
+
+    def get_concentrations(self, specie, enzyme_index):
+        return self.concentrations[enzyme_index, self.species_index[specie], :len(self.time[enzyme_index])]
+
+    def setup_experimental_fret(self):
+        ## (enzyme, time) experimental FRET zero padded like annealed_fraction_array, with a mask of the real time points
+        time_points = max([len(time_vector) for time_vector in self.time])
+        if any([len(self.experimental_fret[i]) != len(self.time[i]) for i, v in enumerate(self.enzyme)]): # Simulated on a finer time grid than the data, nothing to fit
+            self.experimental_fret_array, self.time_mask = None, None
+            return
+        self.experimental_fret_array = np.zeros((len(self.enzyme), time_points))
+        self.time_mask = np.zeros((len(self.enzyme), time_points))
+        for i, v in enumerate(self.enzyme):
+            self.experimental_fret_array[i, :len(self.time[i])] = self.experimental_fret[i]
+            self.time_mask[i, :len(self.time[i])] = 1
 
     def initial_concentration_guesses(self):
         self.C0= []
@@ -173,14 +791,17 @@ class DuplexHybridization:
             self.C0.append(1e-7) # [TAiQ], RNA annealed to DNA quencher strand
         self.C0.append(self.QT) # [Q], free DNA quencher
 
-    def get_total_rna_concentrations(self, prior_to_hybridization_concentrations):
-        self.total_concentrations = [prior_to_hybridization_concentrations[f'TA{x}'] + prior_to_hybridization_concentrations[f'ETA{x}'] for x in range(1,self.n+1)] # TAi,T = [TAi] + [ETAi]
+    def get_total_rna_concentrations(self, kinetic_model):
+        kinetic_model.calculate_total_rna_concentrations()
+        self.total_concentrations = kinetic_model.total_rna_concentrations[:, :self.n] # (condition, TAi,T, time), TAi,T = [TAi] + [ETAi]
 
     def calculate_kq(self):
         i = np.array([I for I in np.arange(1,self.n+1)])
         dG = self.dGo + self.alpha*i # dG for forming hybrid RNA:DNA duplex as function of RNA length
         R = 8.3145e-3 # units of kJ/mol for dG, change to 1.987e-3 if you like kcal/mol but then also need to change dGo and alpha inputs to kcal/mol
-        self.KQ = np.exp(-dG/(R*self.temperature))
+        self.log_KQ = -dG/(R*self.temperature) # ln KQ stays finite for long tails where KQ itself overflows
+        self.KQ = np.exp(self.log_KQ)
+        self.dlog_KQ = {'dGo':-np.ones(self.n)/(R*self.temperature), 'alpha':-i/(R*self.temperature)} # d ln KQ/d dGo and d ln KQ/d alpha
 
     @staticmethod
     def hybrid_duplex_equations(C0, n, QT, TAiT, KQ):
@@ -197,9 +818,37 @@ class DuplexHybridization:
 
         return eqs
 
-    def extract_solved_concentrations(self, solver_result, ei):
-        for index, value in enumerate(self.concentrations.keys()):
-            self.concentrations[value][ei].append(solver_result.x[index])
+    @staticmethod
+    def free_quencher_concentrations(QT, TAiT, log_KQ, tolerance=1e-12, max_iterations=100):
+        ## Mass balance of each RNA length with KQi = [TAiQ]/([TAi]*[Q]) gives [TAiQ] = TAiT*KQi*[Q]/(1 + KQi*[Q]), so the
+        ## 2n + 1 equations in hybrid_duplex_equations reduce to one monotone equation for the free quencher in u = ln[Q]:
+        ##     g(u) = e^u + sum_i TAiT*s_i - QT = 0,     s_i = KQi*[Q]/(1 + KQi*[Q]) = 1/(1 + exp(-(ln KQi + u)))
+        ## Working with ln KQi + u keeps s_i well-conditioned when KQi is very large. TAiT has shape (..., n, time), and every
+        ## point is solved at once by Newton steps on u that fall back to bisection when they leave the bracket
+        ## max(QT - sum TAiT, QT/(1 + sum KQi*TAiT)) <= [Q] <= QT. Returns u with shape (..., time).
+        log_KQ = np.reshape(log_KQ, (-1, 1))
+        total_rna = np.sum(TAiT, axis=-2)
+        with np.errstate(divide='ignore'): # Integrated concentrations can be slightly negative, clip them for the bracket
+            lower = np.maximum(np.log(np.maximum(QT - total_rna, 0)), np.log(QT) - np.logaddexp(0, logsumexp(log_KQ + np.zeros_like(TAiT), b=np.maximum(TAiT, 0), axis=-2)))
+        upper = np.full_like(lower, np.log(QT))
+        u = upper.copy()
+        for iteration in range(max_iterations):
+            s = expit(log_KQ + u[..., None, :])
+            g = np.exp(u) + np.sum(TAiT*s, axis=-2) - QT
+            dg = np.exp(u) + np.sum(TAiT*s*(1 - s), axis=-2)
+            upper = np.where(g > 0, u, upper)
+            lower = np.where(g > 0, lower, u)
+            u_new = u - g/dg
+            outside = (u_new <= lower) | (u_new >= upper)
+            u_new[outside] = 0.5*(lower[outside] + upper[outside])
+            converged = np.all(np.abs(u_new - u) <= tolerance)
+            u = u_new
+            if converged:
+                break
+        return u
+
+    def extract_solved_concentrations(self, solver_result, ei, zi):
+        self.concentrations[ei, :, zi] = solver_result.x
 
     def generate_baseline_matrix(self):
         self.baseline_matrix  =[[] for x in self.enzyme]
@@ -217,6 +866,32 @@ class DuplexHybridization:
             self.baseline_params[i].append([baseline_solutions[0][0]])
             self.baseline_params[i].append([baseline_solutions[0][1]])
 
+    def baseline_normal_matrices(self):
+        ## Entries of X'X for X = [P, 1] for every enzyme concentration, with the padded time points masked out.
+        ## X'X is singular when P does not change over time (e.g. no enzyme), then only the mean FRET is determined.
+        N = np.sum(self.time_mask, axis=1)
+        Sp = np.sum(self.time_mask*self.annealed_fraction_array, axis=1)
+        Spp = np.sum(self.time_mask*self.annealed_fraction_array**2, axis=1)
+        det = N*Spp - Sp**2
+        singular = det <= 1e-12*N*Spp
+        return N, Sp, Spp, np.where(singular, 1, det), singular
+
+    def project_fret_baselines(self):
+        ## Variable projection of the linear baseline params. For X = [P, 1] and experimental FRET y of each enzyme concentration,
+        ## the 2x2 normal equations X'X*[dF, F] = X'y are solved in closed form for all enzyme concentrations at once, and the
+        ## simulated FRET X*[dF, F] is the projection of y onto the columns of X. Gives the same baseline params as
+        ## solve_fret_baseline_params, including the minimum norm solution when P is constant.
+        N, Sp, Spp, det, singular = self.baseline_normal_matrices()
+        y = self.experimental_fret_array
+        P = self.annealed_fraction_array
+        Sy = np.sum(self.time_mask*y, axis=1)
+        Spy = np.sum(self.time_mask*P*y, axis=1)
+        dF = np.where(singular, Sy/N*P[:, 0]/(P[:, 0]**2 + 1), (N*Spy - Sp*Sy)/det)
+        F = np.where(singular, Sy/N/(P[:, 0]**2 + 1), (Spp*Sy - Sp*Spy)/det)
+        self.baseline_params = [[[dF[i]], [F[i]]] for i, v in enumerate(self.enzyme)]
+        self.fret_array = self.time_mask*(dF[:, None]*P + F[:, None])
+        self.fret = [self.fret_array[i, :len(self.time[i])] for i, v in enumerate(self.enzyme)]
+
     def calculate_fret(self):
     ## FRET curve starts high and ends low as full length RNA is converted to
     ## shorter RNA products which have weaker affinities for the capture strand
@@ -235,16 +910,85 @@ class DuplexHybridization:
             self.normalized_fret.append((self.fret[i] - self.baseline_params[i][1])/self.baseline_params[i][0])
             self.normalized_experimental_fret.append((self.experimental_fret[i] - self.baseline_params[i][1])/self.baseline_params[i][0])
 
-    def simulate_hybridization(self, kinetic_model):
+    def simulate_hybridization(self, kinetic_model, params=None):
     ## Solve for concentrations of free and hybridized RNA after stopping reaction and adding quencher DNA strand
     ## Needs initial guesses for concentrations as in the kinetic part
+    ## dGo and alpha are taken from params when given, so they can be fitted, otherwise the experiment values are used
+        if params is not None:
+            if [self.dGo, self.alpha] != [params[k].value for k in self.thermodynamic_params]:
+                self.dGo = params['dGo'].value
+                self.alpha = params['alpha'].value
+                self.calculate_kq()
         self.setup_concentrations()
-        for i, v in enumerate(kinetic_model.enzyme):
-            for z,t in enumerate(kinetic_model.time[i]):
-                self.get_total_rna_concentrations({k:kinetic_model.concentrations[k][i][z] for k in kinetic_model.concentrations.keys()})
-                solver_result = root(self.hybrid_duplex_equations, self.C0, args=(self.n, self.QT, self.total_concentrations, self.KQ), method='hybr')
-                self.extract_solved_concentrations(solver_result, i) # Need enzyme index to extend concentration list for each enzyme concentration
-                self.annealed_fraction[i].append(np.sum([self.concentrations[k][i][z]/self.rna for k in self.concentrations if ('Q' in k) & (k[0] != 'Q')])) # Want everything annealed to Q, i.e. TAiQ, but not free Q
+        self.get_total_rna_concentrations(kinetic_model)
+        if self.engine == 'Reduced':
+            u = self.free_quencher_concentrations(self.QT, self.total_concentrations, self.log_KQ) # (enzyme, time)
+            x = self.log_KQ[:, None] + u[:, None, :] # ln(KQi*[Q]), fraction of each RNA length annealed to Q is expit(x)
+            self.concentrations[:, :self.n] = self.total_concentrations*expit(-x) # TAi
+            self.concentrations[:, self.n:2*self.n] = self.total_concentrations*expit(x) # TAiQ
+            self.concentrations[:, -1] = np.exp(u) # Q
+        else:
+            for i, v in enumerate(kinetic_model.enzyme):
+                for z,t in enumerate(kinetic_model.time[i]):
+                    solver_result = root(self.hybrid_duplex_equations, self.C0, args=(self.n, self.QT, self.total_concentrations[i, :, z], self.KQ), method='hybr')
+                    self.extract_solved_concentrations(solver_result, i, z) # Need enzyme and time indices to place solution in concentration array
+        self.annealed_fraction_array[:] = np.sum(self.concentrations[:, self.n:2*self.n], axis=1)/self.rna # Want everything annealed to Q, i.e. TAiQ, but not free Q
+
+    def calculate_annealed_fraction_sensitivities(self, kinetic_model, sensitivities):
+        ## Derivatives of the annealed fraction with respect to each parameter in sensitivities, by implicit differentiation of
+        ## the free quencher equation g(u) = 0 in free_quencher_concentrations. Rate constants act through dTAiT/dp from the
+        ## kinetic model sensitivities, dGo and alpha through d ln KQi/dp. With s_i = expit(ln KQi + u):
+        ##     du/dp = -sum_i (s_i*dTAiT/dp + TAiT*s_i*(1 - s_i)*d ln KQi/dp) / (e^u + sum_i TAiT*s_i*(1 - s_i))
+        ##     d[TAiQ]/dp = s_i*dTAiT/dp + TAiT*s_i*(1 - s_i)*(d ln KQi/dp + du/dp)
+        ## Works from the solved concentrations, so it applies to either hybridization engine.
+        dTAiT = np.zeros((self.total_concentrations.shape[0], len(sensitivities)) + self.total_concentrations.shape[1:]) # (enzyme, parameter, TAi,T, time)
+        dlog_KQ = np.zeros((len(sensitivities), self.n))
+        if len(kinetic_model.sensitivity_params) > 0:
+            kinetic_model.calculate_total_rna_sensitivities()
+        for j, k in enumerate(sensitivities):
+            if k in kinetic_model.sensitivity_params:
+                dTAiT[:, j] = kinetic_model.total_rna_sensitivities[:, kinetic_model.sensitivity_params.index(k)]
+            elif k in self.thermodynamic_params:
+                dlog_KQ[j] = self.dlog_KQ[k]
+        Q = self.concentrations[:, -1]
+        with np.errstate(divide='ignore'): # Zero padded time points have no free quencher
+            s = expit(self.log_KQ[:, None] + np.log(Q)[:, None, :]) # (enzyme, TAi, time)
+        ds = self.total_concentrations*s*(1 - s)
+        dTAiQ = s[:, None]*dTAiT + ds[:, None]*dlog_KQ[None, :, :, None] # Contributions at fixed [Q]
+        du = -np.sum(dTAiQ, axis=2)/np.where(Q > 0, Q + np.sum(ds, axis=1), 1)[:, None] # (enzyme, parameter, time)
+        dTAiQ += ds[:, None]*du[:, :, None]
+        self.annealed_fraction_sensitivities = np.sum(dTAiQ, axis=2)/self.rna # (enzyme, parameter, time)
+
+    def calculate_fret_sensitivities(self):
+        ## Derivatives of the simulated FRET with respect to the sensitivity parameters, including the change of the least
+        ## squares baseline params (the full Golub-Pereyra Jacobian of the variable projection residual). With X = [P, 1],
+        ## beta = [dF, F] and r = y - X*beta, the normal equations X'X*beta = X'y give dbeta = (X'X)^-1*(dX'*r - X'*dX*beta)
+        ## for dX = [dP, 0], and d(X*beta) = dX*beta + X*dbeta. Solved in closed form for all enzyme concentrations at once.
+        N, Sp, Spp, det, singular = self.baseline_normal_matrices()
+        beta = np.array(self.baseline_params)[:, :, 0] # (enzyme, [dF, F])
+        P = self.annealed_fraction_array[:, None]
+        dP = self.time_mask[:, None]*self.annealed_fraction_sensitivities # (enzyme, parameter, time)
+        r = self.time_mask*(self.experimental_fret_array - beta[:, 0, None]*self.annealed_fraction_array - beta[:, 1, None])
+        rhs_dF = np.sum(dP*(r[:, None] - beta[:, 0, None, None]*P), axis=2) # (enzyme, parameter)
+        rhs_F = -beta[:, 0, None]*np.sum(dP, axis=2)
+        ddF = np.where(singular[:, None], 0, (N[:, None]*rhs_dF - Sp[:, None]*rhs_F)/det[:, None]) # No enzyme means no dependence on the rate constants
+        dF0 = np.where(singular[:, None], 0, (Spp[:, None]*rhs_F - Sp[:, None]*rhs_dF)/det[:, None])
+        fret_sensitivities = beta[:, 0, None, None]*dP + ddF[:, :, None]*P + dF0[:, :, None] # (enzyme, parameter, time)
+        self.fret_sensitivities = [fret_sensitivities[i, :, :len(self.time[i])].T for i, v in enumerate(self.enzyme)] # (time, parameter)
+
+
+worker_kinetic_model = None # Copy of the kinetic model in each process of a DistributiveDeadenylation worker pool
+
+
+def set_worker_kinetic_model(kinetic_model): # Pool initializer, runs once per worker process
+    global worker_kinetic_model
+    worker_kinetic_model = kinetic_model
+
+
+def solve_worker_kinetics(conditions, rate_constants, sensitivities): # Solve a chunk of kernel conditions in a worker process
+    if worker_kinetic_model.batched:
+        return worker_kinetic_model.split_kernel_solution(*worker_kinetic_model.solve_kernel_kinetics(conditions, *rate_constants, sensitivities))
+    return [worker_kinetic_model.split_kernel_solution(*worker_kinetic_model.solve_kernel_kinetics([condition], *rate_constants, sensitivities))[0] for condition in conditions]
 
 
 def propagator(t, C, func, constants): # Used in scipy.integrate.solve_ivp, general propagation function for use by kinetic model objects
@@ -252,19 +996,135 @@ def propagator(t, C, func, constants): # Used in scipy.integrate.solve_ivp, gene
     return np.matmul(R,C) # Calculates concentration fluxes, d/dt C
 
 
-def generate_model_objects(fret_experiment, fit_model):
+def jacobian_propagator(t, C, jac_func, constants): # Used as jac in scipy.integrate.solve_ivp, takes the Jacobian function in place of the relaxation matrix function
+    return jac_func(C, **constants) # Analytic Jacobian of the concentration fluxes, d/dC (d/dt C)
+
+
+def time_limited(func, deadline): # Rate function that stops the integration with a RuntimeError once perf_counter() passes deadline
+    def limited_func(*args):
+        if perf_counter() > deadline:
+            raise RuntimeError('Integration time limit exceeded')
+        return func(*args)
+    return limited_func
+
+
+def dense_matrix(matrix):
+    return matrix.toarray() if issparse(matrix) else matrix
+
+
+tuned_solvers = {} # (integrator, tolerance preset) chosen by auto_tune_solver for each (experiment conditions, n)
+
+
+def solver_key(fret_experiment):
+    return (tuple(fret_experiment.enzyme), tuple(fret_experiment.rna), tuple([tuple(time_vector) for time_vector in fret_experiment.time]), fret_experiment.n)
+
+
+def generate_model_objects(fret_experiment, fit_model, modeling_params=None):
+    if modeling_params is None: # Modeling parameters section of the configuration file, engines default to the fastest option
+        modeling_params = {}
+    integrator, tolerance = modeling_params.get('Integrator', 'BDF'), modeling_params.get('Tolerance preset', 'default')
+    if integrator == 'Auto': # Choice of auto_tune_solver for this experiment, BDF with the tolerance preset until it has run
+        integrator, tolerance = tuned_solvers.get(solver_key(fret_experiment), ('BDF', tolerance))
     if fit_model == 'Distributive':
-        kinetic_model = DistributiveDeadenylation(fret_experiment)
-    hybridization_model = DuplexHybridization(fret_experiment)
+        kinetic_model = DistributiveDeadenylation(fret_experiment, modeling_params.get('Kinetic engine', 'Kernel'), modeling_params.get('Batch conditions', True), 
+        modeling_params.get('Pseudo-first-order', False), modeling_params.get('Pseudo-first-order ratio', 10), modeling_params.get('Kinetics cache size', 256), 
+        modeling_params.get('Worker processes', 1), modeling_params.get('Conservation reduction', False),
+        tolerance, integrator)
+    hybridization_model = DuplexHybridization(fret_experiment, modeling_params.get('Hybridization engine', 'Reduced'), modeling_params.get('Variable projection', True))
     return kinetic_model, hybridization_model
 
 
-def simulate_full_model(params, kinetic_model, hybridization_model):
-    kinetic_model.simulate_kinetics(params)
-    hybridization_model.simulate_hybridization(kinetic_model)
-    hybridization_model.generate_baseline_matrix()
-    hybridization_model.solve_fret_baseline_params()
-    hybridization_model.calculate_fret()
+def pseudo_first_order_deviation(fret_experiment, params, config_params):
+    # Compare the pseudo-first-order closed form solution against the full BDF solution for the conditions it is applied to,
+    # reported as the largest deviation of any total RNA population (fraction of RNA) and of the annealed fraction
+    modeling_params = config_params['Modeling parameters']
+    return reduced_model_deviation(fret_experiment, params, modeling_params, {**modeling_params, 'Pseudo-first-order': False}, 
+    lambda kinetic_model: kinetic_model.pseudo_first_order_conditions)
+
+
+def reduced_model_deviation(fret_experiment, params, modeling_params, full_modeling_params, reduced_conditions):
+    kinetic_model, hybridization_model = generate_model_objects(fret_experiment, modeling_params['Kinetic model'], modeling_params)
+    deviations = {'Enzyme':[], 'RNA':[], 'Population deviation':[], 'Annealed fraction deviation':[]}
+    conditions = reduced_conditions(kinetic_model)
+    if not any(conditions):
+        return deviations
+    full_kinetic_model, full_hybridization_model = generate_model_objects(fret_experiment, modeling_params['Kinetic model'], full_modeling_params)
+    for model, hyb_model in [(kinetic_model, hybridization_model), (full_kinetic_model, full_hybridization_model)]:
+        simulate_full_model(params, model, hyb_model)
+        model.calculate_total_rna_concentrations()
+        model.close_worker_pool()
+    for r, rna in enumerate(kinetic_model.rna):
+        for i, enzyme in enumerate(kinetic_model.enzyme):
+            if conditions[r*len(kinetic_model.enzyme) + i]:
+                c = r*len(kinetic_model.enzyme) + i
+                population_deviation = np.max(np.abs(kinetic_model.total_rna_concentrations[c, :-1] - full_kinetic_model.total_rna_concentrations[c, :-1]))/rna
+                deviations['Enzyme'].append(enzyme)
+                deviations['RNA'].append(rna)
+                deviations['Population deviation'].append(population_deviation)
+                deviations['Annealed fraction deviation'].append(np.max(np.abs(np.array(hybridization_model.annealed_fraction[c]) - np.array(full_hybridization_model.annealed_fraction[c]))))
+    return deviations
+
+
+def auto_tune_solver(fret_experiment, params, config_params, sensitivities=(), repeats=2, time_limit_factor=5):
+    ## Time every integrator with every tolerance preset on params and keep the fastest one whose largest annealed fraction error
+    ## against the reference preset stays within the error bound of the configured tolerance preset. Integrators still running
+    ## after time_limit_factor times the fastest time so far are stopped, which rules out explicit methods in the stiff regime.
+    ## Simulations run in this process without the kinetics cache, each timed as the best of repeats. The choice is kept for the
+    ## experiment so generate_model_objects uses it with the Auto integrator, and returned with the timings of all candidates. Each
+    ## candidate gets a status, Accepted, Above error bound, Timed out or Failed, the last two without a time or error (NaN).
+    modeling_params = {**config_params['Modeling parameters'], 'Kinetics cache size': 0, 'Worker processes': 1}
+    tolerance = modeling_params.get('Tolerance preset', 'default')
+    error_bound = DistributiveDeadenylation.tolerance_errors.get(tolerance, 0)
+    reference_model, reference_hybridization_model = generate_model_objects(fret_experiment, modeling_params['Kinetic model'], 
+    {**modeling_params, 'Integrator': 'BDF', 'Tolerance preset': 'reference'})
+    simulate_full_model(params, reference_model, reference_hybridization_model)
+    reference = reference_hybridization_model.annealed_fraction
+    timings = {'Integrator':[], 'Tolerance preset':[], 'Time':[], 'Annealed fraction error':[], 'Status':[]}
+    best_time, fastest_time = np.inf, np.inf
+    choice = ('BDF', tolerance)
+    for integrator in DistributiveDeadenylation.integrators:
+        for candidate_tolerance in DistributiveDeadenylation.tolerance_errors:
+            kinetic_model, hybridization_model = generate_model_objects(fret_experiment, modeling_params['Kinetic model'], 
+            {**modeling_params, 'Integrator': integrator, 'Tolerance preset': candidate_tolerance})
+            elapsed, error = np.inf, np.nan
+            try:
+                for _ in range(repeats):
+                    start = perf_counter()
+                    kinetic_model.deadline = start + time_limit_factor*fastest_time if np.isfinite(fastest_time) else None
+                    simulate_full_model(params, kinetic_model, hybridization_model, sensitivities)
+                    elapsed = min(elapsed, perf_counter() - start)
+                error = max([np.max(np.abs(np.array(annealed_fraction) - np.array(reference_annealed_fraction))) 
+                for annealed_fraction, reference_annealed_fraction in zip(hybridization_model.annealed_fraction, reference)])
+                status = 'Accepted' if error <= error_bound else 'Above error bound'
+            except Exception: # Stopped at the time limit or failed to integrate
+                elapsed, error = np.nan, np.nan
+                status = 'Timed out' if (kinetic_model.deadline is not None) and (perf_counter() > kinetic_model.deadline) else 'Failed'
+            if status == 'Accepted' and elapsed < best_time:
+                best_time = elapsed
+                choice = (integrator, candidate_tolerance)
+            fastest_time = min(fastest_time, elapsed) if np.isfinite(elapsed) else fastest_time
+            timings['Integrator'].append(integrator)
+            timings['Tolerance preset'].append(candidate_tolerance)
+            timings['Time'].append(elapsed)
+            timings['Annealed fraction error'].append(error)
+            timings['Status'].append(status)
+    tuned_solvers[solver_key(fret_experiment)] = choice
+    return choice, timings
+
+
+def simulate_full_model(params, kinetic_model, hybridization_model, sensitivities=()):
+    # Optionally carry forward sensitivities for the parameters in sensitivities through to the FRET, see objective_jacobian
+    kinetic_model.simulate_kinetics(params, [k for k in sensitivities if k in kinetic_model.rate_constants])
+    hybridization_model.simulate_hybridization(kinetic_model, params)
+    if hybridization_model.variable_projection:
+        hybridization_model.project_fret_baselines()
+    else:
+        hybridization_model.generate_baseline_matrix()
+        hybridization_model.solve_fret_baseline_params()
+        hybridization_model.calculate_fret()
+    if len(sensitivities) > 0:
+        hybridization_model.calculate_annealed_fraction_sensitivities(kinetic_model, sensitivities)
+        hybridization_model.calculate_fret_sensitivities()
     return kinetic_model, hybridization_model
 
 
@@ -275,19 +1135,21 @@ def calculate_residuals_simulate_best_fit_data(fret_expts, opt_params, config_pa
     resid = []
     normalized_resid = []
     for i, fret_expt in enumerate(fret_expts):
-        kinetic_model, hybridization_model = generate_model_objects(fret_expt, config_params['Modeling parameters']['Kinetic model'])
+        kinetic_model, hybridization_model = generate_model_objects(fret_expt, config_params['Modeling parameters']['Kinetic model'], config_params['Modeling parameters'])
+        kinetic_model.dense_output = True # Keep the solver interpolants so the finely sampled curves below need no second integration
         kinetic_model, hybridization_model = simulate_full_model(opt_params[i], kinetic_model, hybridization_model)
+        kinetic_model.close_worker_pool()
         hybridization_model.normalize_fret()
         resid.append(residuals(fret_expt.fret, hybridization_model.fret))
         normalized_resid.append(residuals(hybridization_model.normalized_experimental_fret, hybridization_model.normalized_fret))
 
-        max_time = max(np.array([max(time_vector) for time_vector in fret_expt.time])) # Re-simulate with finely sampled experimental time vectors
+        max_time = max(np.array([max(time_vector) for time_vector in fret_expt.time])) # Sample the best fit kinetics at finely spaced time points
         sim_time = [np.linspace(0, max_time, 300) for time_vector in fret_expt.time]
         sim_fret_expt = deepcopy(fret_expt)
         sim_fret_expt.time = sim_time
-        sim_kinetic_model, sim_hybridization_model = generate_model_objects(sim_fret_expt, config_params['Modeling parameters']['Kinetic model'])
-        sim_kinetic_model.simulate_kinetics(opt_params[i])
-        sim_hybridization_model.simulate_hybridization(sim_kinetic_model)
+        sim_kinetic_model, sim_hybridization_model = generate_model_objects(sim_fret_expt, config_params['Modeling parameters']['Kinetic model'], config_params['Modeling parameters'])
+        sim_kinetic_model.interpolate_kinetics(kinetic_model)
+        sim_hybridization_model.simulate_hybridization(sim_kinetic_model, opt_params[i])
         sim_hybridization_model.baseline_params = hybridization_model.baseline_params # Copy best baseline params for simulating best fit data
         sim_hybridization_model.generate_baseline_matrix() # Don't recalculate baseline params because this was already done above with the optimal params and copied, just make new baseline matrix
         sim_hybridization_model.calculate_fret()
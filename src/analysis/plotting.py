@@ -27,7 +27,7 @@ class PlotHandler:
         self.bar_2d_flag = bar_2d_flag
         self.bar_3d_flag = bar_3d_flag
 
-        unique_enzyme = self.experiments[0].enzyme # FRET plots
+        unique_enzyme = max([experiment.enzyme for experiment in self.experiments], key=len) # FRET plots, enough colors for every dataset
         slice = 1
         points = len(unique_enzyme)
         colormap = cm.inferno
@@ -37,7 +37,7 @@ class PlotHandler:
         self.enzyme_colors = self.enzyme_colors
         self.alphas = [1,0.9,0.8,0.7,0.6,0.5,0.4,0.3]
 
-        t_pop_keys = [k for k in kinetic_models[0].concentrations.keys() if k not in ['E', 'E*']] # 2D and 3D bar plots
+        t_pop_keys = [k for k in kinetic_models[0].species if k not in ['E', 'E*']] # 2D and 3D bar plots
         slice = 1
         points = len(t_pop_keys)
         colormap = cm.coolwarm
@@ -219,18 +219,18 @@ class PlotHandler:
             if j == 0:
                 kinetic_model = kinetic_models[j]
                 kinetic_model.calculate_total_rna_concentrations()
-                color_values = cm.coolwarm(np.linspace(0,1,len(kinetic_model.total_rna_concentrations.keys())))
+                color_values = cm.coolwarm(np.linspace(0,1,len(kinetic_model.total_rna_species)))
 
                 all_populations_fig, axs = plt.subplots(len(experiment.enzyme),2,figsize=(9,len(experiment.enzyme)*2), gridspec_kw={'width_ratios': [3,1]}) # Access fig with data_fit_fig[0], axis with data_fit_fig[1]
                 
                 for i, enzyme in enumerate(experiment.enzyme):
 
                     # all populations plot
-                    for q, k in enumerate(kinetic_model.total_rna_concentrations.keys()):
+                    for q, k in enumerate(kinetic_model.total_rna_species):
                         if k != 'A1': 
-                            axs[i][0].plot(kinetic_model.time[i], kinetic_model.total_rna_concentrations[k][i], label=k, color=color_values[q], alpha=0.8)                
+                            axs[i][0].plot(kinetic_model.time[i], kinetic_model.get_total_rna_concentrations(k, i), label=k, color=color_values[q], alpha=0.8)                
                         else: # Plot A1 on separate axis since it gets very large
-                            axs[i][1].plot(kinetic_model.time[i], kinetic_model.total_rna_concentrations[k][i], label=k, color=color_values[0], alpha=0.8)
+                            axs[i][1].plot(kinetic_model.time[i], kinetic_model.get_total_rna_concentrations(k, i), label=k, color=color_values[0], alpha=0.8)
                     
                     if i == len(experiment.enzyme) - 1:  # Put x-axis label below last plot
                         axs[i][0].set_xlabel('Time (s)')
@@ -286,15 +286,15 @@ class PlotHandler:
                     for ti, time in enumerate(timesample):
                         tindex = (np.abs(kinetic_model.time[i] - time)).argmin()
                         kinetic_model.calculate_total_rna_concentrations()
-                        ax[ti][0].bar(0.0, kinetic_model.concentrations['E*'][i][tindex]/kinetic_model.enzyme[i], color=enzyme_colors[1], label='E*', width=0.5)
-                        ax[ti][0].bar(0.75, kinetic_model.concentrations['E'][i][tindex]/kinetic_model.enzyme[i], color=enzyme_colors[0], label='E', width=0.5)
-                        ax[ti][1].bar(0.0, kinetic_model.total_rna_concentrations[f'TA{kinetic_model.n}'][i][tindex]/kinetic_model.rna, color=t_pop_colors[-1], label=f"TA$_{{{kinetic_model.n}}}$", width=0.5)
-                        ax[ti][1].bar(0.75, kinetic_model.total_rna_concentrations['A1'][i][tindex]/(kinetic_model.rna * (kinetic_model.n - 1)), color=t_pop_colors[0], label="A$_{{{1}}}$", width=0.5)
+                        ax[ti][0].bar(0.0, kinetic_model.get_concentrations('E*', i)[tindex]/kinetic_model.enzyme[i], color=enzyme_colors[1], label='E*', width=0.5)
+                        ax[ti][0].bar(0.75, kinetic_model.get_concentrations('E', i)[tindex]/kinetic_model.enzyme[i], color=enzyme_colors[0], label='E', width=0.5)
+                        ax[ti][1].bar(0.0, kinetic_model.get_total_rna_concentrations(f'TA{kinetic_model.n}', i)[tindex]/kinetic_model.rna, color=t_pop_colors[-1], label=f"TA$_{{{kinetic_model.n}}}$", width=0.5)
+                        ax[ti][1].bar(0.75, kinetic_model.get_total_rna_concentrations('A1', i)[tindex]/(kinetic_model.rna * (kinetic_model.n - 1)), color=t_pop_colors[0], label="A$_{{{1}}}$", width=0.5)
 
-                        for q, k in enumerate(kinetic_model.total_rna_concentrations.keys()):
+                        for q, k in enumerate(kinetic_model.total_rna_species):
                             if k not in ['A1', f"TA{kinetic_model.n}"]:
                                 alen = int(k.split('TA')[1])
-                                ax[ti][2].bar(q, kinetic_model.total_rna_concentrations[k][i][tindex]/kinetic_model.rna, color=t_pop_colors[q], label=f'TA$_{{{alen}}}$')
+                                ax[ti][2].bar(q, kinetic_model.get_total_rna_concentrations(k, i)[tindex]/kinetic_model.rna, color=t_pop_colors[q], label=f'TA$_{{{alen}}}$')
                         
                         ax[ti][2].invert_xaxis()
                         ax[ti][0].set_ylabel(f"Fraction at t: {np.round(kinetic_model.time[i][tindex],0)} s")
@@ -306,7 +306,7 @@ class PlotHandler:
                         ax[ti][0].set_xticks([0, 0.75])
                         ax[ti][1].set_xticks([0, 0.75])                        
                         ax[ti][2].set_xticks([x for x in range(0, kinetic_model.n - 1)])
-                        rna_lens = [int(k.split('TA')[1]) for k in kinetic_model.total_rna_concentrations.keys() if k not in [f'TA{kinetic_model.n}', 'A1']]
+                        rna_lens = [int(k.split('TA')[1]) for k in kinetic_model.total_rna_species if k not in [f'TA{kinetic_model.n}', 'A1']]
                         if ti < len(timesample) - 1:
                             ax[ti][0].set_xticklabels([])
                             ax[ti][1].set_xticklabels([])
@@ -354,7 +354,7 @@ class PlotHandler:
                         tindex = (np.abs(kinetic_model.time[ei] - time)).argmin()
                         species_vector = [int(x.split('TA')[1]) for x in rna_species]
                         enzyme_vector = [enz*1e6 for x in species_vector]
-                        fraction_vector = [kinetic_model.total_rna_concentrations[x][ei][tindex]/kinetic_model.rna for x in rna_species]
+                        fraction_vector = [kinetic_model.get_total_rna_concentrations(x, ei)[tindex]/kinetic_model.rna for x in rna_species]
 
                         species_matrix.append(species_vector)
                         enzyme_matrix.append(enzyme_vector)
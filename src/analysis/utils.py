@@ -20,6 +20,16 @@ def setup_parameters(config_params, initial_guess_params):
     opt_params = {k:[] for k in config_params['Modeling parameters']['Fit parameters'].keys() if config_params['Modeling parameters']['Fit parameters'][k]['Vary'] == True}
     return  hybridization_params, initial_guess_params, varied_params, opt_params
 
+def load_global_datasets(config_params, hybridization_params):
+    # Data and hybridization params of each dataset in a global fit, datasets may override QT, n and Temperature
+    dataset_names, datasets = [], []
+    for name, dataset in config_params['Global fit']['Datasets'].items():
+        dataset_hybridization_params = dict(hybridization_params)
+        dataset_hybridization_params.update({k:dataset[k] for k in ['QT', 'n', 'Temperature'] if k in dataset})
+        dataset_names.append(name)
+        datasets.append((pd.read_csv(dataset['Data file to fit']), dataset_hybridization_params))
+    return dataset_names, datasets
+
 def create_experiment_dataframe(time, avgFRET, stdFRET, E0, S0):
     data_dict = {'Time':[],'FRET':[],'Error':[], 'Enzyme':[], 'RNA':[]} # Input data is list of lists, needs to be unraveled into one list for making data frame
     data_dict['Time'] = [t for time_vector in time for t in time_vector]
@@ -36,4 +46,12 @@ def make_dictionary(key_list, value_list):
 def write_optimal_parameter_csv(opt_params, opt_param_units, file):
     opt_params_dict = {'Parameter':[k for k in opt_params], 'Value':[opt_params[k].value for k in opt_params], 'Error':[opt_params[k].stderr for k in opt_params], 'Units':[i for i in opt_param_units]}
     opt_params_df = pd.DataFrame(opt_params_dict)
-    opt_params_df.to_csv(f"output/{file}")
\ No newline at end of file
+    opt_params_df.to_csv(f"output/{file}")
+
+def write_deviation_csv(deviations, file):
+    deviation_df = pd.DataFrame(deviations)
+    deviation_df.to_csv(f"output/{file}", index=False)
+
+def write_solver_tuning_csv(timings, file):
+    timings_df = pd.DataFrame(timings)
+    timings_df.to_csv(f"output/{file}", index=False)